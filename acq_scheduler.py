@@ -0,0 +1,167 @@
+import heapq
+import threading
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor
+import hwmc_logging as log
+
+MODULE = os.path.basename(__file__)
+
+NUM_WORKERS = 8     # Default size of the acquisition worker pool
+MAX_SLEEP = 0.1     # Longest the scheduler sleeps at once, so that it notices a stop request promptly
+
+# Kinds of scheduled work
+POLL = 0    # Regular monitor poll, repeated every interval
+STEP = 1    # One step of a device's control loop, requested by the device's next_step()
+
+
+class AcqScheduler:
+    '''Polls many LabJacks from a fixed-size worker pool on a shared timeline'''
+    def __init__(self, devices, log_msg_q, interval, num_workers=NUM_WORKERS):
+        '''Create a scheduler for a set of devices
+        Each device is given its own offset within the polling interval, so samples are spread evenly across
+        the interval instead of all being taken on the same second boundary. A device that is still busy with
+        its previous poll when its next slot comes round skips that slot. Each poll is told its slot time and how
+        many of the device's slots were missed since its last poll. A device can also be woken between
+        slots with wake(), to execute its queued commands straight away. After any work, a device whose
+        next_step() returns a delay is stepped again after that delay, independently of its polling slots. When
+        the scheduler stops, once every worker has finished, each device's halt() is called.
+
+        Arguments
+        devices -- dictionary of devices keyed by location, each with poll(scheduled, missed), service_commands(),
+                   step(), next_step() and halt() methods
+        log_msg_q -- a Queue object for logging messages
+        interval -- polling interval for each device in seconds
+        num_workers -- number of worker threads polling devices
+        '''
+        self.stop = False
+        self.devices = devices
+        self.log_msg_q = log_msg_q
+        self.interval = interval
+        self.num_workers = num_workers
+        self.skipped = 0
+        self._missed = {}
+        self._busy = set()
+        self._wake_pending = set()
+        self._stepping = set()
+        self._cond = threading.Condition()
+        self._slots = []
+        self._pool = None
+
+    def run(self):
+        num_dev = len(self.devices)
+        self.log_msg_q.put((log.INFO, MODULE, "Starting acquisition scheduler for {} devices with {} workers"
+                            .format(num_dev, self.num_workers)))
+        t_start = (int(time.time() / self.interval) + 1) * self.interval
+        slots = self._slots
+        with self._cond:
+            slots[:] = [(t_start + i * self.interval / num_dev, key, POLL)
+                        for i, key in enumerate(sorted(self.devices))]
+            heapq.heapify(slots)
+        with ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='acq') as pool:
+            self._pool = pool
+            while not self.stop and slots:
+                with self._cond:
+                    due, key, kind = slots[0]
+                    t = time.time()
+                    if due > t:
+                        # Steps requested by workers wake the scheduler early
+                        self._cond.wait(min(due - t, MAX_SLEEP))
+                        continue
+                    if kind == POLL:
+                        # If we have fallen more than a whole interval behind, drop the missed slots rather than
+                        # bursting to catch up
+                        next_due = due + self.interval
+                        if next_due <= t:
+                            dropped = int((t - next_due) / self.interval) + 1
+                            next_due += dropped * self.interval
+                            self._miss(key, dropped)
+                        heapq.heapreplace(slots, (next_due, key, POLL))
+                    else:
+                        heapq.heappop(slots)
+                        self._stepping.discard(key)
+                    # A busy device skips this slot; a step is requested again when the device's work finishes
+                    if key in self._busy:
+                        if kind == POLL:
+                            self._miss(key, 1)
+                        continue
+                    self._busy.add(key)
+                    missed = self._missed.pop(key, 0) if kind == POLL else 0
+                if kind == POLL:
+                    pool.submit(self._poll, key, due, missed)
+                else:
+                    pool.submit(self._step, key)
+            self._pool = None
+        # Nothing steps the devices any more, so any moves still in progress are ended
+        for key in sorted(self.devices):
+            try:
+                self.devices[key].halt()
+            except Exception as e:
+                self.log_msg_q.put((log.ERROR, MODULE, "Halting device {} failed: {}".format(key, e)))
+        self.log_msg_q.put((log.INFO, MODULE, "Acquisition scheduler stopped"))
+
+    def _miss(self, key, count):
+        # Called with the lock held; the count is passed to the device's next poll
+        self.skipped += count
+        self._missed[key] = self._missed.get(key, 0) + count
+
+    def wake(self, key):
+        '''Have a device execute its queued commands now rather than at its next slot; safe from any thread'''
+        pool = self._pool
+        if pool is None:
+            return
+        with self._cond:
+            if key in self._busy:
+                # Picked up when the device's current work finishes
+                self._wake_pending.add(key)
+                return
+            self._busy.add(key)
+        self._submit(pool, self._service, key)
+
+    def _submit(self, pool, fn, key):
+        if pool is not None:
+            try:
+                pool.submit(fn, key)
+                return
+            except RuntimeError:
+                pass
+        # The scheduler has stopped
+        with self._cond:
+            self._busy.discard(key)
+
+    def _poll(self, key, scheduled, missed):
+        try:
+            self.devices[key].poll(scheduled, missed)
+        except Exception as e:
+            self.log_msg_q.put((log.ERROR, MODULE, "Polling device {} failed: {}".format(key, e)))
+        finally:
+            self._finish(key)
+
+    def _service(self, key):
+        try:
+            self.devices[key].service_commands()
+        except Exception as e:
+            self.log_msg_q.put((log.ERROR, MODULE, "Commanding device {} failed: {}".format(key, e)))
+        finally:
+            self._finish(key)
+
+    def _step(self, key):
+        try:
+            self.devices[key].step()
+        except Exception as e:
+            self.log_msg_q.put((log.ERROR, MODULE, "Stepping device {} failed: {}".format(key, e)))
+        finally:
+            self._finish(key)
+
+    def _finish(self, key):
+        delay = self.devices[key].next_step()
+        with self._cond:
+            if delay is not None and key not in self._stepping:
+                self._stepping.add(key)
+                heapq.heappush(self._slots, (time.time() + delay, key, STEP))
+                self._cond.notify()
+            if key not in self._wake_pending:
+                self._busy.discard(key)
+                return
+            self._wake_pending.discard(key)
+        self._submit(self._pool, self._service, key)
@@ -0,0 +1,142 @@
+import argparse
+import functools
+import queue
+import random
+import socket
+import threading
+import time
+import commands as cmds
+import dsa_labjack as dlj
+import labjack_ports as port
+import sim_ljm
+from acq_scheduler import AcqScheduler
+from server_loop import ServerLoop
+
+# Measures the time from the command server receiving a command to the write reaching the (simulated) LabJack
+
+NUM_ANTS = 110
+NUM_COMMANDS = 200
+COMMAND_GAP = 0.02      # Mean time between commands in s
+
+
+class NullMonitor:
+    # Monitor queue that discards packets, so only command handling is measured
+    def post(self, mp):
+        pass
+
+
+class TimedCommands(cmds.HwmcCommands):
+    def __init__(self, cmd_qs, log_msg_q):
+        super().__init__(cmd_qs, log_msg_q)
+        self.received = {}
+
+    def handle_request(self, line, reply):
+        self.received[line.split()[0][1:]] = time.perf_counter()
+        super().handle_request(line, reply)
+
+
+def percentile(values, p):
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+def summary(values):
+    if not values:
+        return "no samples"
+    values = sorted(values)
+    return "median {:.3f} ms, 95% {:.3f} ms, max {:.3f} ms".format(1e3 * percentile(values, 0.5),
+                                                                   1e3 * percentile(values, 0.95), 1e3 * values[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark command latency against simulated LabJacks")
+    parser.add_argument('--ants', type=int, default=NUM_ANTS, help="number of simulated antennas")
+    parser.add_argument('--commands', type=int, default=NUM_COMMANDS, help="number of commands to send")
+    parser.add_argument('--threads', action='store_true', help="one thread per antenna instead of the scheduler")
+    args = parser.parse_args()
+
+    log_msg_q = queue.Queue()
+    mp_q = NullMonitor()
+    ants = dlj.LabjackList(log_msg_q, mp_q, simulate=True, num_sim=args.ants).ants
+    cmd_qs = {}
+    for ant_num in ants:
+        cmd_qs[ant_num] = cmds.CommandQueue(5)
+        ants[ant_num].cmd_q = cmd_qs[ant_num]
+
+    threads = []
+    scheduler = None
+    if args.threads:
+        for ant in ants.values():
+            threads.append(threading.Thread(target=ant.run))
+    else:
+        scheduler = AcqScheduler(ants, log_msg_q, dlj.POLLING_INTERVAL)
+        for ant_num, q in cmd_qs.items():
+            q.listener = functools.partial(scheduler.wake, ant_num)
+        threads.append(threading.Thread(target=scheduler.run))
+    commands = TimedCommands(cmd_qs, log_msg_q)
+    server_loop = ServerLoop(log_msg_q)
+    server_loop.add(commands)
+    threads.append(threading.Thread(target=server_loop.run))
+    for t in threads:
+        t.start()
+    time.sleep(1.5)
+
+    s = socket.create_connection((cmds.SERVER_IP, cmds.SERVER_PORT))
+    completed = {}
+    nacked = set()
+
+    def read_replies():
+        # A command ends with its completion reply, or with a nack if no antenna queued it, e.g. because its
+        # command queue was full
+        for line in s.makefile('r'):
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            if fields[0] == 'complete':
+                completed[fields[1]] = time.perf_counter()
+            elif fields[0] == 'nack':
+                nacked.add(fields[1])
+            else:
+                continue
+            if len(completed) + len(nacked) == args.commands:
+                return
+
+    reader = threading.Thread(target=read_replies)
+    reader.start()
+    sent = {}
+    for i in range(args.commands):
+        ant_num = random.randint(1, args.ants)
+        req_id = str(i)
+        sent[req_id] = (ant_num, time.perf_counter())
+        s.sendall("#{} nd {} a {}\n".format(req_id, ant_num, random.choice(['on', 'off'])).encode('ascii'))
+        time.sleep(random.expovariate(1 / COMMAND_GAP))
+    reader.join()
+    round_trips = [completed[req_id] - t_sent for req_id, (_, t_sent) in sent.items() if req_id in completed]
+
+    # Commands that were nacked, or whose write cannot be found, have no receipt to write time
+    latencies = []
+    for req_id, (ant_num, t_sent) in sent.items():
+        t_received = commands.received.get(req_id)
+        if req_id not in completed or t_received is None:
+            continue
+        device = sim_ljm.devices[ants[ant_num].lj_handle]
+        writes = [t for t, name, _ in device.writes if name == port.ND_A and t >= t_received]
+        if writes:
+            latencies.append(min(writes) - t_received)
+    s.close()
+    for ant in ants.values():
+        ant.stop = True
+    if scheduler is not None:
+        scheduler.stop = True
+    server_loop.stop()
+    for t in threads:
+        t.join()
+
+    print("{} commands to {} antennas ({}), {} nacked:".format(args.commands, args.ants,
+                                                               'thread per antenna' if args.threads else 'scheduler',
+                                                               len(nacked)))
+    print("  receipt to write: {}, {} samples dropped".format(summary(latencies), args.commands - len(latencies)))
+    print("  send to completion reply: {}".format(summary(round_trips)))
+
+
+if __name__ == '__main__':
+    main()
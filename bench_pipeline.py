@@ -0,0 +1,218 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import commands as cmds
+import dsa_labjack as dlj
+import hw_monitor as mon
+import monitor_server as ms
+import mp_protocol as proto
+from acq_scheduler import AcqScheduler
+from monitor_server import MpServer
+from server_loop import ServerLoop
+
+# Runs the acquisition pipeline against simulated LabJacks: antenna polling, the monitor queue and its file
+# writing, the monitor server and a subscribing client in a separate process. Reports throughput, the latency
+# from a sample being posted to it reaching the client, queue depths, CPU and memory, and saves them as JSON so
+# that versions can be compared.
+
+ANT_COUNTS = '110,500,2000'
+INTERVALS = '1.0'
+DURATION = 10.0         # Measured time for each run in s
+WARMUP = 3.0            # Time for each run to settle before measuring, in s
+STATS_INTERVAL = 0.25   # Time between samples of queue depths and memory in s
+OUTPUT = 'bench_pipeline.json'
+SUBSCRIPTION = 'ant*,*'
+ANT_CMD_Q_DEPTH = 5     # As in hardware_monitor_control; every poll checks its antenna's command queue
+
+
+class TimedMonitor_q(mon.Monitor_q):
+    '''Monitor queue that records when each packet was posted'''
+    def __init__(self, file_prefix, log_msg_q, store, points):
+        super().__init__(file_prefix, log_msg_q, store, points)
+        self.posted = {}
+
+    def post(self, mp):
+        self.posted.setdefault((mp[1], mp[0]), time.time())
+        super().post(mp)
+
+
+def run_client(conn, t_start, t_end):
+    # Subscribing client, run in its own process. Sends back the time each sample was first received in the
+    # measurement window, keyed by (source, MJD), and the CPU time it used.
+    s = socket.create_connection((ms.SERVER_IP, ms.SERVER_PORT))
+    s.sendall("{}\n{}\n".format(proto.PROTOCOL_REQUEST, SUBSCRIPTION).encode('ascii'))
+    s.settimeout(0.1)
+    decoder = proto.MpDecoder()
+    received = {}
+    cpu_start = None
+    while time.time() < t_end:
+        try:
+            data = s.recv(1 << 16)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        t = time.time()
+        frames = decoder.feed(data)
+        if t < t_start:
+            continue
+        if cpu_start is None:
+            cpu_start = time.process_time()
+        for frame_type, points in frames:
+            if frame_type == proto.FRAME_DATA:
+                for mjd, source, _, _ in points:
+                    received.setdefault((source, mjd), t)
+    s.close()
+    conn.send((received, time.process_time() - (cpu_start or time.process_time())))
+
+
+def rss_bytes():
+    # Current resident memory, or the peak where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, p):
+    return values[min(int(p * len(values)), len(values) - 1)] if values else float('nan')
+
+
+def summary(values):
+    return {'mean': sum(values) / len(values) if values else 0.0, 'max': max(values) if values else 0}
+
+
+def run_config(num_ants, interval, args, work_dir):
+    '''Run the pipeline with one antenna count and polling interval and return its results
+
+    Arguments
+    num_ants -- number of simulated antennas
+    interval -- polling interval of each antenna in s
+    args -- parsed command line
+    work_dir -- directory for the monitor point files
+    '''
+    log_msg_q = queue.Queue()
+    mp_q = TimedMonitor_q(os.path.join(work_dir, "bench-{}-{}-".format(num_ants, interval)), log_msg_q, args.store,
+                          dlj.MP_NAMES)
+    ants = dlj.LabjackList(log_msg_q, mp_q, simulate=True, num_sim=num_ants).ants
+    for ant in ants.values():
+        ant.cmd_q = cmds.CommandQueue(ANT_CMD_Q_DEPTH)
+    server_loop = ServerLoop(log_msg_q)
+    server_loop.add(MpServer(mp_q, log_msg_q))
+    scheduler = AcqScheduler(ants, log_msg_q, interval, args.workers)
+    threads = [threading.Thread(target=mp_q.run), threading.Thread(target=server_loop.run)]
+    for t in threads:
+        t.start()
+    time.sleep(0.5)
+
+    t_start = time.time() + args.warmup
+    t_end = t_start + args.duration
+    ctx = multiprocessing.get_context('spawn')
+    conn, child_conn = ctx.Pipe()
+    client = ctx.Process(target=run_client, args=(child_conn, t_start, t_end))
+    client.start()
+    threads.append(threading.Thread(target=scheduler.run))
+    threads[-1].start()
+
+    while time.time() < t_start:
+        time.sleep(0.01)
+    cpu_start = time.process_time()
+    mp_stats = mp_q.stats()
+    written_start, skipped_start = mp_stats['written'], scheduler.skipped
+    in_depths, out_depths, rss = [], [], []
+    while time.time() < t_end:
+        mp_stats = mp_q.stats()
+        in_depths.append(mp_stats['in_depth'])
+        out_depths.append(mp_stats['out_depth'])
+        rss.append(rss_bytes())
+        time.sleep(STATS_INTERVAL)
+    cpu = time.process_time() - cpu_start
+    mp_stats = mp_q.stats()
+    skipped = scheduler.skipped - skipped_start
+    received, client_cpu = conn.recv()
+    client.join()
+
+    scheduler.stop = True
+    server_loop.stop()
+    mp_q.stop = True
+    for t in threads:
+        t.join()
+
+    posted = [t for t in mp_q.posted.values() if t_start <= t < t_end]
+    latencies = sorted(t - mp_q.posted[key] for key, t in received.items() if key in mp_q.posted)
+    return {'ants': num_ants,
+            'interval': interval,
+            'duration': args.duration,
+            'polled_per_s': len(posted) / args.duration,
+            'written_per_s': (mp_stats['written'] - written_start) / args.duration,
+            'samples_per_s': len(received) / args.duration,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p99': percentile(latencies, 0.99),
+            'latency_max': latencies[-1] if latencies else float('nan'),
+            'skipped_polls': skipped,
+            'coalesced': mp_stats['coalesced'],
+            'out_dropped': mp_stats['out_dropped'],
+            'in_depth': summary(in_depths),
+            'out_depth': summary(out_depths),
+            'cpu_percent': 100.0 * cpu / args.duration,
+            'client_cpu_percent': 100.0 * client_cpu / args.duration,
+            'rss_mb': max(rss) / 1e6}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the acquisition pipeline against simulated LabJacks")
+    parser.add_argument('--ants', default=ANT_COUNTS, help="comma-separated antenna counts")
+    parser.add_argument('--intervals', default=INTERVALS, help="comma-separated polling intervals in s")
+    parser.add_argument('--duration', type=float, default=DURATION, help="measured time for each run in s")
+    parser.add_argument('--warmup', type=float, default=WARMUP, help="settling time before each run in s")
+    parser.add_argument('--workers', type=int, default=8, help="acquisition worker threads")
+    parser.add_argument('--store', default=mon.STORE_TEXT, choices=[mon.STORE_TEXT, mon.STORE_BINARY, mon.STORE_BOTH],
+                        help="monitor point file format")
+    parser.add_argument('--output', default=OUTPUT, help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    results = {'commit': git_commit(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'workers': args.workers,
+               'store': args.store,
+               'runs': []}
+    print("{:>6} {:>8} {:>10} {:>10} {:>9} {:>9} {:>8} {:>8} {:>6} {:>8}"
+          .format('ants', 'interval', 'polled/s', 'samples/s', 'p50 ms', 'p99 ms', 'in max', 'out max', 'cpu %',
+                  'rss MB'))
+    with tempfile.TemporaryDirectory() as work_dir:
+        for num_ants in [int(n) for n in args.ants.split(',')]:
+            for interval in [float(i) for i in args.intervals.split(',')]:
+                run = run_config(num_ants, interval, args, work_dir)
+                results['runs'].append(run)
+                print("{:6d} {:8.3f} {:10.1f} {:10.1f} {:9.2f} {:9.2f} {:8d} {:8d} {:6.1f} {:8.1f}"
+                      .format(num_ants, interval, run['polled_per_s'], run['samples_per_s'],
+                              1e3 * run['latency_p50'], 1e3 * run['latency_p99'], run['in_depth']['max'],
+                              run['out_depth']['max'], run['cpu_percent'], run['rss_mb']))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
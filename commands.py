@@ -1,24 +1,188 @@
 import hwmc_logging as log
-import socket
-import select
+from dsa_labjack import is_number
+import asyncio
+import queue
+import time
 import os
 
 MODULE = os.path.basename(__file__)
 
 SERVER_IP = 'localhost'
 SERVER_PORT = 50001
-BLOCK_SIZE = 1024
+REPLY_BUFFER_LIMIT = 1 << 16    # Unsent reply bytes after which replies to a client that does not read them stop
 
 CONTINUE = 1
 STOP = -1
 
+# Moves of more than one antenna start their drives in waves, to limit the inrush current
+MOVE_WAVE_SIZE = 10     # Antennas started together
+MOVE_WAVE_GAP = 1.0     # Time between waves in s
+
+MAX_ANT_NUM = 9999  # Highest antenna number accepted in a target list, which limits the size of a range
+
+
+def parse_groups(definitions):
+    '''Parse definitions of named groups of antennas, e.g. ['west_arm=1-20'], which are given on the command line
+
+    Returns a dictionary of group name to target list, for parse_targets. Raises ValueError if a definition is not
+    valid.
+    '''
+    groups = {}
+    for definition in definitions:
+        name, sep, targets = definition.lower().partition('=')
+        # A group name must not be usable as a target itself
+        if not sep or not name or ',' in name or parse_targets(name) is not None or parse_targets(targets) is None:
+            raise ValueError("invalid group definition: {}".format(definition))
+        groups[name] = targets
+    return groups
+
+
+def parse_targets(targets, groups=None):
+    '''Parse a target list into antenna numbers
+
+    A target list is a comma-separated list of 'all' (or '0'), antenna numbers, ranges such as '1-20' and names of
+    groups, a dictionary of group name to target list as made by parse_groups. Returns a sorted list of antenna
+    numbers, ['all'] if any target is 'all', or None if any target is not valid.
+    '''
+    ants = set()
+    everything = False
+    for target in targets.split(','):
+        if target in ('all', '0'):
+            everything = True
+            continue
+        if groups and target in groups:
+            group = parse_targets(groups[target])
+            if group is None:
+                return None
+            if group == ['all']:
+                everything = True
+            else:
+                ants.update(group)
+            continue
+        first, sep, last = target.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if sep else first
+        except ValueError:
+            return None
+        if first <= 0 or last < first or last > MAX_ANT_NUM:
+            return None
+        ants.update(range(first, last + 1))
+    return ['all'] if everything else sorted(ants)
+
+
+def format_targets(ants):
+    # The reverse of parse_targets for a list of antenna numbers, e.g. [1, 2, 3, 7] gives '1-3,7'
+    ranges = []
+    for ant in sorted(ants):
+        if ranges and ranges[-1][1] == ant - 1:
+            ranges[-1][1] = ant
+        else:
+            ranges.append([ant, ant])
+    return ','.join(str(a) if a == b else "{}-{}".format(a, b) for a, b in ranges)
+
+
+class CommandQueue(queue.Queue):
+    '''An antenna command queue that calls listener() after each command is queued, e.g. to wake the antenna'''
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.listener = None
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        listener = self.listener
+        if listener is not None:
+            listener()
+
+
+class CommandRequest:
+    '''A command sent to a set of antennas, tracked until every antenna has reported completion'''
+    def __init__(self, req_id, reply, ants):
+        self.req_id = req_id
+        self.reply = reply
+        self.pending = set(ants)
+        self.num_ok = 0
+        self.num_failed = 0
+
+    def ant_done(self, ant, error):
+        self._record(ant, error)
+        self.pending.discard(ant)
+        if not self.pending:
+            self.complete()
+
+    def _record(self, ant, error):
+        # Count and report one antenna's outcome
+        if error is None:
+            self.num_ok += 1
+            self.reply("done {} ant{} ok".format(self.req_id, ant))
+        else:
+            self.num_failed += 1
+            self.reply("done {} ant{} error {}".format(self.req_id, ant, error))
+
+    def complete(self):
+        self.reply("complete {} ok={} error={}".format(self.req_id, self.num_ok, self.num_failed))
+
+
+class ArrayMove(CommandRequest):
+    '''A move of many antennas, started in staggered waves and tracked until every antenna has finished'''
+    def __init__(self, req_id, reply, ants, ant_cmd, wave_size=MOVE_WAVE_SIZE, wave_gap=MOVE_WAVE_GAP):
+        super().__init__(req_id, reply, ants)
+        self.ants = ants
+        self.ant_cmd = ant_cmd
+        self.wave_size = wave_size
+        self.wave_gap = wave_gap
+        self.t_start = None
+        self.started = {}
+        self.results = {}
+
+    def num_waves(self):
+        return (len(self.ants) + self.wave_size - 1) // self.wave_size
+
+    def start(self, commands):
+        # Runs on the server loop; each wave is queued by a timer on the loop
+        self.t_start = time.time()
+        for wave in range(self.num_waves()):
+            ants = self.ants[wave * self.wave_size: (wave + 1) * self.wave_size]
+            commands.loop.call_later(wave * self.wave_gap, self._start_wave, commands, ants)
+
+    def _start_wave(self, commands, ants):
+        t = time.time()
+        for ant in ants:
+            self.started[ant] = t
+        _, busy, _ = commands._fan_out(self.ant_cmd, ants, self)
+        # Busy antennas are already off the pending list, so the move is completed once, after they are all recorded
+        for ant in busy:
+            self._record(ant, "command queue full")
+        if busy and not self.pending:
+            self.complete()
+
+    def _record(self, ant, error):
+        self.results[ant] = (error, time.time() - self.started[ant])
+        super()._record(ant, error)
+
+    def complete(self):
+        # A table of the result and move time of every antenna, then the time for the whole array
+        for ant in sorted(self.results):
+            error, seconds = self.results[ant]
+            if error is None:
+                self.reply("result {} ant{} ok {:.1f}".format(self.req_id, ant, seconds))
+            else:
+                self.reply("result {} ant{} error {:.1f} {}".format(self.req_id, ant, seconds, error))
+        self.reply("complete {} ok={} error={} slew={:.1f}".format(self.req_id, self.num_ok, self.num_failed,
+                                                                   time.time() - self.t_start))
+
 
 class HwmcCommands:
-    def __init__(self, cmd_qs, log_msg_q):
+    def __init__(self, cmd_qs, log_msg_q, groups=None):
         self.stop = False
         self.stop_request = False
         self.cmd_qs = cmd_qs
         self.log_msg_q = log_msg_q
+        self.groups = groups or {}
+        self.server = None
+        self.loop = None
+        self.connections = set()
+        self.next_id = 0
 
     def command_thread(self):
         while not self.stop:
@@ -30,61 +194,161 @@ class HwmcCommands:
                 if retval == STOP:
                     self.stop_request = True
 
-    def command_server_thread(self):
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setblocking(False)
-        server.bind((SERVER_IP, SERVER_PORT))
-        server.listen(5)
-        inputs = [server]
-        outputs = []
+    async def start(self):
+        # Runs on the ServerLoop alongside the monitor server
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._serve_client, SERVER_IP, SERVER_PORT)
 
-        while not self.stop:
-            readable, writable, exceptional = select.select(inputs, outputs, inputs, 1)
-            for s in readable:
-                if s is server:
-                    connection, client_address = s.accept()
-                    connection.setblocking(False)
-                    inputs.append(connection)
-                else:
-                    try:
-                        data = s.recv(BLOCK_SIZE)
-                        data = data.decode('ascii').lower()
-                        ant_cmds = data.splitlines()
-                        # Do not check for validity; that will be done in the command processor.
-                        for ant_cmd in ant_cmds:
-                            self._q_command(ant_cmd)
-                        if data:
-                            if s not in outputs:
-                                outputs.append(s)
-                    except (ConnectionResetError, ConnectionAbortedError):
-                        inputs.remove(s)
-                        outputs.remove(s)
-
-            for s in exceptional:
-                inputs.remove(s)
-                if s in outputs:
-                    outputs.remove(s)
-                s.close()
+    async def close(self):
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await self.server.wait_closed()
+
+    async def _serve_client(self, reader, writer):
+        self.connections.add(writer)
+
+        def reply(text):
+            if not writer.is_closing() and writer.transport.get_write_buffer_size() < REPLY_BUFFER_LIMIT:
+                writer.write((text + '\n').encode('ascii'))
+
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                self.handle_request(data.decode('ascii', 'replace'), reply)
+        except (ConnectionResetError, ConnectionAbortedError, ValueError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    def handle_request(self, line, reply):
+        '''Send one command line from a network client to its antennas
+
+        A line is '[#id] command targets [arguments]', where targets is a target list as used by parse_targets.
+        Without an id the server assigns one. The reply is 'ack id accepted=... busy=... unknown=...' when at least
+        one antenna queued the command, or 'nack id reason' otherwise; busy antennas had full command queues.
+        Each antenna that queued the command then sends 'done id antN ok' or 'done id antN error message', and
+        the last is followed by 'complete id ok=N error=M'.
+        '''
+        fields = line.strip().lower().split()
+        if not fields:
+            return
+        if fields[0].startswith('#'):
+            req_id = fields.pop(0)[1:]
+        else:
+            req_id = self._new_id()
+        if len(fields) < 2:
+            reply("nack {} expected: command targets [arguments]".format(req_id))
+            return
+        if fields[0] == 'stop':
+            reply("nack {} stop is only accepted from the console".format(req_id))
+            return
+        ants = parse_targets(fields[1], self.groups)
+        if ants is None:
+            reply("nack {} invalid targets: {}".format(req_id, fields[1]))
+            return
+        ant_cmd = [fields[0]] + fields[2:]
+        if self._is_array_move(ant_cmd, ants):
+            self._array_move(req_id, reply, ant_cmd, ants)
+            return
+        request = CommandRequest(req_id, reply, [])
+        accepted, busy, unknown = self._fan_out(ant_cmd, ants, request)
+        report = "accepted={} busy={} unknown={}".format(format_targets(accepted), format_targets(busy),
+                                                          format_targets(unknown))
+        reply("{} {} {}".format('ack' if accepted else 'nack', req_id, report))
+
+    def _new_id(self):
+        # Request IDs are only assigned on the server loop, so they need no lock
+        self.next_id += 1
+        return str(self.next_id)
+
+    def _is_array_move(self, ant_cmd, ants):
+        # Moves to an elevation for more than one antenna are coordinated
+        return ant_cmd[0] == 'move' and len(ant_cmd) > 1 and is_number(ant_cmd[1]) and (ants == ['all'] or
+                                                                                         len(ants) > 1)
+
+    def _array_move(self, req_id, reply, ant_cmd, ants):
+        '''Start a coordinated move: 'move targets elevation [wave=N] [gap=S]'
+
+        Replies 'ack id accepted=... unknown=... waves=N', then 'done' lines as antennas finish, then a 'result
+        id antN ok|error seconds [message]' line for every antenna and 'complete id ok=N error=M slew=S'.
+        '''
+        options = {'wave': MOVE_WAVE_SIZE, 'gap': MOVE_WAVE_GAP}
+        for option in ant_cmd[2:]:
+            name, _, value = option.partition('=')
+            if name not in options or not is_number(value) or float(value) < 0:
+                reply("nack {} invalid move option: {}".format(req_id, option))
+                return
+            options[name] = float(value)
+        wave_size = max(int(options['wave']), 1)
+        if ants == ['all']:
+            ants = sorted(self.cmd_qs)
+        unknown = [ant for ant in ants if ant not in self.cmd_qs]
+        ants = [ant for ant in ants if ant in self.cmd_qs]
+        if not ants:
+            reply("nack {} accepted= unknown={}".format(req_id, format_targets(unknown)))
+            return
+        request = ArrayMove(req_id, reply, ants, ant_cmd[: 2], wave_size, options['gap'])
+        reply("ack {} accepted={} unknown={} waves={}".format(req_id, format_targets(ants), format_targets(unknown),
+                                                              request.num_waves()))
+        request.start(self)
+
+    def _fan_out(self, ant_cmd, ants, request=None):
+        # Queue a command for each antenna without waiting on any of them. Returns the antennas that queued it,
+        # those whose queues were full and those that do not exist.
+        if ants == ['all']:
+            ants = sorted(self.cmd_qs)
+        accepted, busy, unknown = [], [], []
+        done = None if request is None else self._done_callback(request)
+        for ant in ants:
+            q = self.cmd_qs.get(ant)
+            if q is None:
+                unknown.append(ant)
+                continue
+            if request is not None:
+                request.pending.add(ant)
+            try:
+                q.put_nowait((ant_cmd, done))
+                accepted.append(ant)
+            except queue.Full:
+                busy.append(ant)
+                if request is not None:
+                    request.pending.discard(ant)
+        if busy:
+            self.log_msg_q.put((log.WARN, MODULE, "Command queue full for ants {}, dropped: {}"
+                                .format(format_targets(busy), ' '.join(ant_cmd))))
+        return accepted, busy, unknown
+
+    def _done_callback(self, request):
+        # Antennas report completion from their own threads; the reply is made on the server loop
+        def done(ant, error):
+            self.loop.call_soon_threadsafe(request.ant_done, ant, error)
+        return done
+
+    def _log_reply(self, text):
+        self.log_msg_q.put((log.INFO, MODULE, text))
+
+    def _console_move(self, ant_cmd, ants):
+        self._array_move(self._new_id(), self._log_reply, ant_cmd, ants)
 
     def _q_command(self, cmd_in):
-        c = cmd_in.strip().lower()
-        line = c.split(' ')
-        n = len(line)
-        cmd = line[0]
-        if cmd == 'stop':
+        # Console commands: 'stop', or 'command targets [arguments]' without replies
+        line = cmd_in.strip().lower().split()
+        if not line:
+            return CONTINUE
+        if line[0] == 'stop':
             return STOP
-        if n > 1:
-            ant = line[1]
-            ant_cmd = [cmd] + line[2:]
-            if ant is not '':
-                if ant == 'all' or ant == '0':
-                    for q in self.cmd_qs:
-                        q.put(ant_cmd)
-                else:
-                    try:
-                        ant = int(ant)
-                    except ValueError:
-                        ant = -1
-                    if 0 < ant and ant in self.cmd_qs:
-                        self.cmd_qs[ant].put(ant_cmd)
+        if len(line) > 1:
+            ants = parse_targets(line[1], self.groups)
+            ant_cmd = [line[0]] + line[2:]
+            if ants is None:
+                self.log_msg_q.put((log.WARN, MODULE, "Invalid targets: {}".format(line[1])))
+            elif self._is_array_move(ant_cmd, ants) and self.loop is not None:
+                # Coordinated on the server loop, with the replies going to the log
+                self.loop.call_soon_threadsafe(self._console_move, ant_cmd, ants)
+            else:
+                self._fan_out(ant_cmd, ants)
         return CONTINUE
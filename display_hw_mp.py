@@ -1,7 +1,10 @@
+import time
+T_START = time.perf_counter()   # Start of the imports, for --profile-startup
+import argparse
 import socket
 import math
 import tkinter as tk
-import time
+from hwmc_startup import StartupProfile
 
 HOST_IP = 'localhost'
 MP_SERVER_PORT = 50000
@@ -289,7 +292,8 @@ class MpShow:
         if mp_points:
             for m in mp_points:
                 try:
-                    mjd, ant, mp, val = m.split(',')
+                    # Snapshot lines sent on subscription carry the age of the value as an extra field
+                    mjd, ant, mp, val = m.split(',')[: 4]
                 except ValueError:
                     return
                 if mp in self.a_fields:
@@ -340,9 +344,8 @@ class MpShow:
             self.connected = False
         if self.connected:
             self.show_msg("Connected to '{}'".format(HOST_IP))
-            mp = ''
-            for key in mps:
-                mp = "{}{},{}\n".format(mp, self.ant, key)
+            # A single wildcard subscription covers every monitor point of the antenna
+            mp = "{},*\n".format(self.ant)
             self.read_socket.sendall(mp.encode('ascii'))
             self.text_ant_sel.delete(1.0, tk.END)
             self.text_ant_sel.insert(tk.END, self.ant)
@@ -405,10 +408,25 @@ class MpShow:
             self.write_socket.sendall(cmd.encode('ascii'))
 
 
-window = MpShow()
-while not window.quit:
+def main():
+    parser = argparse.ArgumentParser(description="Display and control a single DSA-110 antenna")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print the time taken by each phase of start up")
+    args = parser.parse_args()
+    profile = StartupProfile(T_START)
+    profile.mark('imports')
+    window = MpShow()
     window.update()
-    t = 1 - time.time() % 1
-    time.sleep(t)
+    profile.mark('window')
+    if args.profile_startup:
+        print(profile.report())
+    while not window.quit:
+        window.update()
+        t = 1 - time.time() % 1
+        time.sleep(t)
+
+    print("Finished")
+
 
-print("Finished")
+if __name__ == '__main__':
+    main()
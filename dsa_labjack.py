@@ -1,25 +1,56 @@
-from labjack import ljm
+try:
+    from labjack import ljm
+except ImportError:
+    ljm = None  # Only simulated LabJacks can be used; see use_simulator()
 from encoder import convert_encoder
+import encoder
+import lj_stream
+from lj_stream import AinStream
+from mp_record import MpSchema, MpRecord
 import hwmc_logging as log
+import hwmc_stats as stats
 import time
-from astropy.time import Time
+import math
+import queue
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hwmc_time
 import os
 import labjack_ports as port
 
 MODULE = os.path.basename(__file__)
 
-NUM_SIM = 110
+NUM_SIM = 110  # Number of simulated LabJacks by default
 
 NO_TYPE = 0
 ANT_TYPE = 1
 ABE_TYPE = 2
 
 POLLING_INTERVAL = 1
+JITTER_SAMPLES = 16     # Number of samples the per-antenna polling jitter is averaged over
+MJD_DIGITS = 9          # Decimal places of sample timestamps, about 0.1 ms
+
+BRINGUP_WORKERS = 16    # Maximum number of LabJacks opened and configured concurrently
+OPEN_TIMEOUT_MS = 3000  # TCP open timeout for each LabJack
+
+
+def use_simulator(num_devices=NUM_SIM, **options):
+    '''Use simulated LabJacks from sim_ljm in place of the LabJack library, here and in lj_stream
+
+    Arguments
+    num_devices -- number of simulated antenna LabJacks
+    options -- further settings passed to sim_ljm.configure(), e.g. latency or fault_rate
+    '''
+    global ljm
+    import sim_ljm
+    sim_ljm.configure(num_devices, **options)
+    ljm = sim_ljm
+    lj_stream.ljm = sim_ljm
 
 
 # -------------- LabJack initialization class ------------------
 class LabjackList:
-    def __init__(self, log_msg_q, mp_q, simulate=False):
+    def __init__(self, log_msg_q, mp_q, simulate=False, num_sim=NUM_SIM, sim_options=None):
         log_msg_q.put((log.INFO, MODULE, "Searching for LabJack T7's"))
         # Set up arrays to hold device information for discovered LabJack devices
         self.num_found = 0
@@ -27,48 +58,76 @@ class LabjackList:
         self.num_abe = 0
         self.ants = {}
         self.abes = {}
+        self.num_failed = 0
+        self.bringup_times = {}
         self.stop_time = 0.0
         self.move_time = 0.0
         if simulate:
-            a_device_types = []
-            a_connection_types = []
-            a_serial_numbers = []
-            a_ip_addresses = []
-            self.num_found = NUM_SIM
-            for i in range(NUM_SIM):
-                a_device_types.append(ljm.constants.dtT7)
-                a_connection_types.append(ljm.constants.ctETHERNET)
-                a_serial_numbers.append("-2")
-                a_ip_addresses.append("192.168.1.{}".format(i))
-        else:
-            try:
-                (self.num_found, a_device_types, a_connection_types, a_serial_numbers, a_ip_addresses) =\
-                            ljm.listAll(ljm.constants.dtT7, ljm.constants.ctTCP)
-            except ljm.LJMError as e:
-                log_msg_q.put((log.FATAL, MODULE, "Error searching for LabJack devices. LJMError: {}".format(e)))
-                raise ljm.LJMError
+            use_simulator(num_sim, **(sim_options or {}))
+        elif ljm is None:
+            log_msg_q.put((log.FATAL, MODULE, "LabJack library not installed; only simulation is available"))
+            raise ImportError("labjack.ljm is not installed")
+        try:
+            (self.num_found, a_device_types, a_connection_types, a_serial_numbers, a_ip_addresses) =\
+                        ljm.listAll(ljm.constants.dtT7, ljm.constants.ctTCP)
+        except ljm.LJMError as e:
+            log_msg_q.put((log.FATAL, MODULE, "Error searching for LabJack devices. LJMError: {}".format(e)))
+            raise ljm.LJMError
         if self.num_found > 0:
-            sim_ant_num = 1
-            for i in range(self.num_found):
-                lj_handle = None
-                try:
-                    lj_handle = ljm.open(a_device_types[i], a_connection_types[i], a_serial_numbers[i])
-                except ljm.LJMError:
-                    self.num_found -= self.num_found
-                    if self.num_found <= 0:
-                        return
-
-                if simulate:
-                    (lj_type, lj_location) = (ANT_TYPE, sim_ant_num)
-                    sim_ant_num += 1
-                else:
-                    (lj_type, lj_location) = self._get_type_and_location(lj_handle)
-                if lj_type == ANT_TYPE:
-                    self.ants[lj_location] = DsaAntLabjack(lj_handle, lj_location, log_msg_q, mp_q)
-                    self.num_ant += 1
-                elif lj_type == ABE_TYPE:
-                    self.abes[lj_location] = DsaAbeLabjack(lj_handle, lj_location, log_msg_q, mp_q)
-                    self.num_abe += 1
+            # Bring up devices concurrently so that a slow or dead unit only ties up one worker
+            ljm.writeLibraryConfigS("LJM_OPEN_TCP_DEVICE_TIMEOUT_MS", OPEN_TIMEOUT_MS)
+            t_start = time.time()
+            with ThreadPoolExecutor(max_workers=min(BRINGUP_WORKERS, self.num_found)) as pool:
+                futures = []
+                for i in range(self.num_found):
+                    # Simulated devices are numbered in order, so there can be more than the 127 that FIO_STATE
+                    # can identify
+                    sim_location = i + 1 if simulate else None
+                    futures.append(pool.submit(self._bring_up, a_device_types[i], a_connection_types[i],
+                                               a_serial_numbers[i], sim_location, log_msg_q, mp_q))
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result is None:
+                        self.num_failed += 1
+                        continue
+                    lj_type, lj_location, device, bringup_time = result
+                    if lj_type == ANT_TYPE:
+                        self.ants[lj_location] = device
+                        self.num_ant += 1
+                    elif lj_type == ABE_TYPE:
+                        self.abes[lj_location] = device
+                        self.num_abe += 1
+                    self.bringup_times[(lj_type, lj_location)] = bringup_time
+            elapsed = time.time() - t_start
+            slowest = max(self.bringup_times.values()) if self.bringup_times else 0.0
+            log_msg_q.put((log.INFO, MODULE, "Brought up {} antennas and {} backends in {:.3f} s "
+                                             "(slowest device {:.3f} s, {} failed)"
+                           .format(self.num_ant, self.num_abe, elapsed, slowest, self.num_failed)))
+
+    @staticmethod
+    def _bring_up(device_type, connection_type, serial_number, sim_location, log_msg_q, mp_q):
+        # Open, identify and configure a single LabJack in a bring-up worker thread. Returns
+        # (type, location, device, bring-up time in s), or None if the device could not be brought up.
+        t_start = time.time()
+        lj_handle = None
+        try:
+            lj_handle = ljm.open(device_type, connection_type, serial_number)
+            if sim_location is not None:
+                (lj_type, lj_location) = (ANT_TYPE, sim_location)
+            else:
+                (lj_type, lj_location) = LabjackList._get_type_and_location(lj_handle)
+            if lj_type == ANT_TYPE:
+                device = DsaAntLabjack(lj_handle, lj_location, log_msg_q, mp_q)
+            else:
+                device = DsaAbeLabjack(lj_handle, lj_location, log_msg_q, mp_q)
+        except ljm.LJMError as e:
+            log_msg_q.put((log.ERROR, MODULE, "Unable to bring up LabJack {}. LJMError: {}".format(serial_number, e)))
+            if lj_handle is not None:
+                ljm.close(lj_handle)
+            return None
+        bringup_time = time.time() - t_start
+        log_msg_q.put((log.DEBUG, MODULE, "LabJack {} brought up in {:.3f} s".format(serial_number, bringup_time)))
+        return lj_type, lj_location, device, bringup_time
 
     @staticmethod
     def _get_type_and_location(lj_handle):
@@ -95,6 +154,9 @@ DOWN = 2
 DRIVE_RATE = 40  # deg/min
 TIMEOUT = 60  # seconds timeout for elevation acquisition
 ACQ_WINDOW = 0.1  # Allowable position error in deg
+CONTROL_INTERVAL = 0.1  # Default time between steps of the elevation control loop in s
+STALL_TIME = 5.0  # A move that makes less than STALL_DEG progress in this many seconds has stalled
+STALL_DEG = 0.1
 
 DRIVE_BITS = {OFF: [1, 1],
               UP: [0, 1],
@@ -106,6 +168,135 @@ A_WRITES = [0, 0, 0]
 A_NUM_VALS = [14, 1, 1]
 LEN_VALS = sum(A_NUM_VALS)
 
+# Positions of values in the raw frame returned by eNames
+ENCODER_INDEX = 0
+DIO_INDEX = 15
+
+# Calibration of the remaining analog values: (monitor point, raw index, scale, offset)
+AIN_CAL = [('foc_temp', 1, 50.0, -25.0),
+           ('lna_a_current', 2, 100.0, 0.0),
+           ('rf_a_power', 3, 28.571, -90.0),
+           ('laser_a_voltage', 4, 1.0, 0.0),
+           ('feb_a_current', 5, 1000.0, 0.0),
+           ('feb_a_temp', 6, 50.0, -25.0),
+           ('lna_b_current', 7, 1000.0, 0.0),
+           ('rf_b_power', 8, 28.571, -90.0),
+           ('laser_b_voltage', 9, 1.0, 0.0),
+           ('feb_b_current', 10, 100.0, 0.0),
+           ('feb_b_temp', 11, 50.0, -25.0),
+           ('psu_voltage', 12, 1.0, 0.0),
+           ('lj_temp', 14, 1.0, -ABSOLUTE_ZERO)]
+
+# Fields of DIO_STATE: (monitor point, bit shift, mask, invert). Noise diode outputs are active low.
+DIO_BITS = [('drive_state', 8, 0b11, 0),
+            ('nd1', 20, 0b01, 1),
+            ('nd2', 21, 0b01, 1),
+            ('brake', 16, 0b01, 0),
+            ('plus_limit', 17, 0b01, 0),
+            ('minus_limit', 18, 0b01, 0),
+            ('fan_err', 22, 0b01, 0)]
+
+# Channels streamed by default in high-rate mode
+STREAM_MPS = ['ant_el', 'rf_a_power', 'rf_b_power', 'lna_a_current', 'lna_b_current']
+STREAM_RATE = 500           # Default scan rate in Hz
+STREAM_DUMP_SECONDS = 10    # Default length of full-rate data written by 'stream dump'
+
+# Antenna monitor points and their initial values
+ANT_MPS = [('drive_state', 0),      # 0 = off, 1 = up, 2 = down
+           ('brake', 0),            # 0 = off, 1 = on
+           ('plus_limit', 0),
+           ('minus_limit', 0),
+           ('fan_err', 0),
+           ('ant_el', 0.0),
+           ('nd1', 0),
+           ('nd2', 0),
+           ('foc_temp', -273.15),
+           ('lna_a_current', 0.0),
+           ('lna_b_current', 0.0),
+           ('rf_a_power', 0.0),
+           ('rf_b_power', 0.0),
+           ('laser_a_voltage', 0.0),
+           ('laser_b_voltage', 0.0),
+           ('feb_a_current', 0.0),
+           ('feb_b_current', 0.0),
+           ('feb_a_temp', 0.0),
+           ('feb_b_temp', 0.0),
+           ('lj_temp', -273.15),
+           ('psu_voltage', 0.0),
+           ('move_target', float('nan')),   # Target elevation of the move in progress, NaN when not moving
+           ('move_err', 0.0),               # Target minus current elevation in deg
+           ('move_eta', 0.0),               # Estimated time to reach the target in s
+           ('read_time', 0.0),              # Time taken by the LabJack to return this sample in s
+           ('poll_late', 0.0),              # Start of the read minus its scheduled time in s
+           ('poll_jitter', 0.0),            # RMS of poll_late over about the last JITTER_SAMPLES samples in s
+           ('missed_polls', 0)]             # Polling slots missed since the antenna was brought up
+ANT_SCHEMA = MpSchema([mp[0] for mp in ANT_MPS], [mp[1] for mp in ANT_MPS])
+
+# Decode tables with monitor point names replaced by their positions in ANT_SCHEMA. Each sample is decoded as soon
+# as it is read, since the scheduler spreads antenna reads across the polling interval; decoding is about a
+# twentieth of the cost of a sample, so holding samples back to decode a whole tick at once would gain little.
+ANT_EL_SLOT = ANT_SCHEMA.index['ant_el']
+MOVE_SLOTS = [ANT_SCHEMA.index[mp] for mp in ('move_target', 'move_err', 'move_eta')]
+TIMING_SLOTS = [ANT_SCHEMA.index[mp] for mp in ('read_time', 'poll_late', 'poll_jitter', 'missed_polls')]
+AIN_SLOTS = [(ANT_SCHEMA.index[mp], index, scale, offset) for mp, index, scale, offset in AIN_CAL]
+DIO_SLOTS = [(ANT_SCHEMA.index[mp], shift, mask, invert) for mp, shift, mask, invert in DIO_BITS]
+
+# Time taken by every antenna read and how late it started, published by hwmc_stats
+LJM_READ = stats.histogram('ljm_read')
+POLL_LATE = stats.histogram('poll_late')
+
+INIT_NAMES = ["AIN_ALL_RANGE",  # Input voltage range
+              "FIO_DIRECTION",  # Input register for LabJack ID
+              "EIO_DIRECTION",  # Output register for drive motor control
+              "CIO_DIRECTION",  # Input register for drive status
+              "MIO_DIRECTION"]  # Input/output for noise diode and fan
+INIT_VALUES = [10.0, 0, 3, 0, 3]
+
+
+class ElevationMove:
+    '''Closed-loop move to a target elevation, advanced one control step at a time'''
+    def __init__(self, target, el, done, timeout=TIMEOUT):
+        '''Start tracking a move
+
+        Arguments
+        target -- target elevation in deg
+        el -- current elevation in deg
+        done -- function called with the antenna number and None or an error message when the move ends, or None
+        timeout -- longest time allowed for the move in s
+        '''
+        t = time.time()
+        self.target = target
+        self.done = done
+        self.deadline = t + timeout
+        self.err = target - el
+        self.direction = OFF
+        self.error = None
+        self._progress_el = el
+        self._progress_time = t
+
+    def eta(self):
+        return abs(self.err) * 60.0 / DRIVE_RATE
+
+    def step(self, el):
+        # Returns the drive direction for the new elevation, or None when the move has ended, with self.error set
+        # if it failed
+        t = time.time()
+        self.err = self.target - el
+        if abs(self.err) <= ACQ_WINDOW:
+            return None
+        if t > self.deadline:
+            self.error = "Move timed out {:.2f} deg from target".format(self.err)
+            return None
+        direction = UP if self.err > 0 else DOWN
+        if direction != self.direction or abs(el - self._progress_el) >= STALL_DEG:
+            self._progress_el = el
+            self._progress_time = t
+        elif t - self._progress_time > STALL_TIME:
+            self.error = "Move stalled at {:.2f} deg".format(el)
+            return None
+        self.direction = direction
+        return direction
+
 
 class DsaAntLabjack:
     def __init__(self, lj_handle, ant_num, log_msg_q, mp_q):
@@ -116,117 +307,188 @@ class DsaAntLabjack:
         self.log_msg_q = log_msg_q
         self.cmd_q = None
         self.mp_q = mp_q
-        self.monitor_points = {'drive_state': 0,    # 0 = off, 1 = up, 2 = down
-                               'brake': 0,          # 0 = off, 1 = on
-                               'plus_limit': 0,
-                               'minus_limit': 0,
-                               'fan_err': 0,
-                               'ant_el': 0.0,
-                               'nd1': 0,
-                               'nd2': 0,
-                               'foc_temp': -273.15,
-                               'lna_a_current': 0.0,
-                               'lna_b_current': 0.0,
-                               'rf_a_power': 0.0,
-                               'rf_b_power': 0.0,
-                               'laser_a_voltage': 0.0,
-                               'laser_b_voltage': 0.0,
-                               'feb_a_current': 0.0,
-                               'feb_b_current': 0.0,
-                               'feb_a_temp': 0.0,
-                               'feb_b_temp': 0.0,
-                               'lj_temp': -273.15,
-                               'psu_voltage': 0.0}
-
-        # Initialize LabJack settings
-        self.valid = True
+        self.stream = None
+        self.stream_thread = None
+        self.move = None
+        self.drive = OFF
+        self.control_interval = CONTROL_INTERVAL
+        self._done = None
+        self.read_time = 0.0
+        self.late_var = 0.0
+        self.missed_polls = 0
+        self.mp_values = list(ANT_SCHEMA.defaults)
+        self.monitor_points = ANT_SCHEMA.record()
+
+        # Initialize LabJack settings. Only mark valid once configured, so that a failed bring-up closes the
+        # handle exactly once.
         self._init_labjack()
+        self.valid = True
         self.log_msg_q.put((log.INFO, MODULE, "Antenna {} connected".format(self.ant_num)))
 
     def _init_labjack(self):
-        # Analog section
-        # Input voltage range
-        ljm.eWriteName(self.lj_handle, "AIN_ALL_RANGE", 10.0)
-        # Digital section
-        # Input register for LabJack ID
-        ljm.eWriteName(self.lj_handle, "FIO_DIRECTION", 0)
-        # Output register for drive motor control
-        ljm.eWriteName(self.lj_handle, "EIO_DIRECTION", 3)
-        # Input register for drive status
-        ljm.eWriteName(self.lj_handle, "CIO_DIRECTION", 0)
-        # Input/output for noise diode and fan
-        ljm.eWriteName(self.lj_handle, "MIO_DIRECTION", 3)
+        # Configure everything in a single round trip
+        ljm.eWriteNames(self.lj_handle, len(INIT_NAMES), INIT_NAMES, INIT_VALUES)
 
     def __del__(self):
         if self.valid is True:
             ljm.close(self.lj_handle)
 
-    def get_data(self):
+    def read_raw(self):
         a_values = [0] * LEN_VALS
+        t_start = time.perf_counter()
         a_values = ljm.eNames(self.lj_handle, NUM_FRAMES, A_NAMES, A_WRITES, A_NUM_VALS, a_values)
-        self.monitor_points['ant_el'] = convert_encoder(a_values[0])
-        self.monitor_points['foc_temp'] = 50 * a_values[1] - 25
-        self.monitor_points['lna_a_current'] = 100 * a_values[2]
-        self.monitor_points['rf_a_power'] = 28.571 * a_values[3] - 90
-        self.monitor_points['laser_a_voltage'] = a_values[4]
-        self.monitor_points['feb_a_current'] = 1000 * a_values[5]
-        self.monitor_points['feb_a_temp'] = 50 * a_values[6] - 25
-        self.monitor_points['lna_b_current'] = 1000 * a_values[7]
-        self.monitor_points['rf_b_power'] = 28.571 * a_values[8] - 90
-        self.monitor_points['laser_b_voltage'] = a_values[9]
-        self.monitor_points['feb_b_current'] = 100 * a_values[10]
-        self.monitor_points['feb_b_temp'] = 50 * a_values[11] - 25
-        self.monitor_points['psu_voltage'] = a_values[12]
-        self.monitor_points['lj_temp'] = a_values[14] - ABSOLUTE_ZERO
-        dig_val = int(a_values[15])
-        self.monitor_points['drive_state'] = (dig_val >> 8) & 0b11
-        self.monitor_points['nd1'] = ~(dig_val >> 20) & 0b01
-        self.monitor_points['nd2'] = ~(dig_val >> 21) & 0b01
-        self.monitor_points['brake'] = (dig_val >> 16) & 0b01
-        self.monitor_points['plus_limit'] = (dig_val >> 17) & 0b01
-        self.monitor_points['minus_limit'] = (dig_val >> 18) & 0b01
-        self.monitor_points['fan_err'] = (dig_val >> 22) & 0b01
-        ts = float("{:.6f}".format(Time.now().mjd))
+        self.read_time = time.perf_counter() - t_start
+        LJM_READ.record(self.read_time)
+        return a_values
+
+    def get_data(self, scheduled=None, missed=0):
+        '''Read, decode and post one sample
+
+        The sample is timestamped with the start of the read. Its timing monitor points record how late the read
+        started and how long it took, so the scheduled time and the end of the read can be recovered.
+
+        Arguments
+        scheduled -- time.time() at which the sample was due; the start of the read if not given
+        missed -- number of polling slots missed since the previous sample
+        '''
+        t_read = time.time()
+        a_values = self.read_raw()
+        mp_values = self.mp_values
+        mp_values[ANT_EL_SLOT] = convert_encoder(a_values[ENCODER_INDEX])
+        for slot, index, scale, offset in AIN_SLOTS:
+            mp_values[slot] = scale * a_values[index] + offset
+        dig_val = int(a_values[DIO_INDEX])
+        for slot, shift, mask, invert in DIO_SLOTS:
+            mp_values[slot] = ((dig_val >> shift) ^ invert) & mask
+        late = 0.0 if scheduled is None else t_read - scheduled
+        POLL_LATE.record(late)
+        self.late_var += (late * late - self.late_var) / JITTER_SAMPLES
+        self.missed_polls += missed
+        mp_values[TIMING_SLOTS[0]], mp_values[TIMING_SLOTS[1]] = self.read_time, late
+        mp_values[TIMING_SLOTS[2]], mp_values[TIMING_SLOTS[3]] = self.late_var ** 0.5, self.missed_polls
+        move = self.move
+        if move is None:
+            mp_values[MOVE_SLOTS[0]], mp_values[MOVE_SLOTS[1]], mp_values[MOVE_SLOTS[2]] = float('nan'), 0.0, 0.0
+        else:
+            mp_values[MOVE_SLOTS[0]], mp_values[MOVE_SLOTS[1]], mp_values[MOVE_SLOTS[2]] = (move.target, move.err,
+                                                                                            move.eta())
+        # Post an immutable snapshot, so later samples cannot change a packet that is still being processed
+        self.monitor_points = MpRecord(ANT_SCHEMA, mp_values)
+        ts = round(hwmc_time.mjd(t_read), MJD_DIGITS)
         self.mp_q.post((ts, "ant{}".format(self.ant_num), self.monitor_points))
         return self.monitor_points
 
     @staticmethod
-    def cmd_help():
+    def cmd_help(args=None):
         print("Available commands:")
         print("\thelp:\t\tGives this help")
         print("\tmove arg:\tmove the antenna\n\t\t\t\targ = up|down|stop|<angle>")
         print("\tnd arg:\tswitch noise diode\n\t\t\t\targ = off|on")
+        print("\tstream arg:\thigh-rate streaming\n\t\t\t\targ = start [rate]|stop|dump [seconds]")
 
     def execute_cmd(self, cmd):
         lj_ant_cmds = {'nd': self.switch_nd,
                        'move': self.move_ant,
                        'brake': self.switch_brake,
+                       'stream': self.switch_stream,
                        'help': self.cmd_help}
 
+        # Returns None if the command succeeded, otherwise a description of the error
         cmd_name = cmd[0]
         args = cmd[1:]
-        if cmd_name in lj_ant_cmds:
-            lj_ant_cmds[cmd_name](args)
-        else:
+        if cmd_name not in lj_ant_cmds:
             self.cmd_help()
-        return
+            return "Unknown command: {}".format(cmd_name)
+        try:
+            return lj_ant_cmds[cmd_name](args)
+        except ljm.LJMError as e:
+            self.log_msg_q.put((log.ERROR, MODULE, "Ant {}: '{}' failed: {}".format(self.ant_num, cmd_name, e)))
+            return str(e)
+
+    def _run_cmd(self, cmd, done):
+        # Each command is queued with a function to call with the outcome, or None. A command that carries on
+        # after returning, like a move, takes the function with _take_done() and calls it when it ends. Any
+        # failure, not only the LabJack's, is reported, so that the request always completes.
+        self._done = done
+        error = "'{}' did not finish".format(cmd[0])
+        try:
+            error = self.execute_cmd(cmd)
+        except Exception as e:
+            error = "'{}' failed: {}".format(cmd[0], e)
+            self.log_msg_q.put((log.ERROR, MODULE, "Ant {}: {}".format(self.ant_num, error)))
+        finally:
+            done = self._take_done()
+            if done is not None:
+                done(self.ant_num, error)
+
+    def _take_done(self):
+        done, self._done = self._done, None
+        return done
+
+    def service_commands(self):
+        # Execute every waiting command without blocking. The scheduler calls this as soon as a command is queued.
+        while True:
+            try:
+                cmd, done = self.cmd_q.get_nowait()
+            except queue.Empty:
+                return
+            self.cmd_q.task_done()
+            self._run_cmd(cmd, done)
+
+    def poll(self, scheduled=None, missed=0):
+        self.get_data(scheduled, missed)
+        self.service_commands()
+
+    def next_step(self):
+        # Seconds until step() should next be called, or None when there is no move in progress
+        return None if self.move is None else self.control_interval
 
     def run(self):
+        # Sample on each polling interval boundary, and wait for commands in between so that they are executed
+        # as soon as they arrive. Moves are stepped at their own rate.
+        next_step = 0.0
+        scheduled = time.time()
+        missed = 0
         while not self.stop:
-            self.get_data()
-            if not self.cmd_q.empty():
-                cmd = self.cmd_q.get()
+            self.poll(scheduled, missed)
+            next_poll = (int(scheduled / POLLING_INTERVAL) + 1) * POLLING_INTERVAL
+            while not self.stop:
+                t = time.time()
+                if self.move is not None and t >= next_step:
+                    self.step()
+                    next_step = t + self.control_interval
+                    continue
+                if t >= next_poll:
+                    break
+                wait = next_poll - t if self.move is None else min(next_poll, next_step) - t
+                try:
+                    cmd, done = self.cmd_q.get(timeout=wait)
+                except queue.Empty:
+                    continue
                 self.cmd_q.task_done()
-                self.execute_cmd(cmd)
-            t = time.time()
-            time.sleep(POLLING_INTERVAL - t % POLLING_INTERVAL)
+                self._run_cmd(cmd, done)
+            # Boundaries that passed while a command was executing are counted as missed rather than made up
+            missed = int((time.time() - next_poll) / POLLING_INTERVAL)
+            scheduled = next_poll + missed * POLLING_INTERVAL
+        self.halt()
         self.log_msg_q.put((log.INFO, MODULE, "Antenna {} disconnecting".format(self.ant_num)))
 
+    def halt(self):
+        # Called when the antenna is no longer being controlled. A move or drive in progress is ended, leaving the
+        # drive off and the brake on.
+        if self.move is None and self.drive == OFF:
+            return
+        try:
+            self._end_move("Move stopped by shutdown")
+        except ljm.LJMError as e:
+            msg = "Ant {}: Unable to stop drive. LJMError: {}".format(self.ant_num, e)
+            self.log_msg_q.put((log.ERROR, MODULE, msg))
+
     def switch_nd(self, pol_state):
         if len(pol_state) != 2:
-            self.log_msg_q.put((log.ERROR, MODULE, "Ant {}: Invalid number of noise diode arguments"
-                                .format(self.ant_num)))
-            return
+            msg = "Ant {}: Invalid number of noise diode arguments".format(self.ant_num)
+            self.log_msg_q.put((log.ERROR, MODULE, msg))
+            return msg
         (pol, state) = pol_state
         if state == 'off':
             state_val = 1
@@ -235,10 +497,10 @@ class DsaAntLabjack:
         else:
             msg = "Ant {}: Invalid noise diode state requested: {}".format(self.ant_num, state)
             self.log_msg_q.put((log.ERROR, MODULE, msg))
-            return
+            return msg
         if pol == 'ab' or pol == 'both':
             msg = "Ant {}: Turning both polarizations noise diode {}".format(self.ant_num, state)
-            ljm.eWriteNames(self.lj_handle, 1, [port.ND_A, port.ND_B], [state_val, state_val])
+            ljm.eWriteNames(self.lj_handle, 2, [port.ND_A, port.ND_B], [state_val, state_val])
         elif pol == 'a':
             msg = "Ant {}: Turning polarization a noise diode {}".format(self.ant_num, state)
             ljm.eWriteName(self.lj_handle, port.ND_A, state_val)
@@ -247,6 +509,8 @@ class DsaAntLabjack:
             ljm.eWriteName(self.lj_handle, port.ND_B, state_val)
         else:
             msg = "Ant {}: Invalid noise diode state requested: {}".format(self.ant_num, pol)
+            self.log_msg_q.put((log.ERROR, MODULE, msg))
+            return msg
         self.log_msg_q.put((log.ERROR, MODULE, msg))
 
     def switch_brake(self, state):
@@ -260,62 +524,133 @@ class DsaAntLabjack:
             ljm.eWriteName(self.lj_handle, port.BRAKE, 1)
         else:
             msg = "Ant {}: Invalid brake state requested: {}".format(self.ant_num, state)
+            self.log_msg_q.put((log.ERROR, MODULE, msg))
+            return msg
         self.log_msg_q.put((log.ERROR, MODULE, msg))
 
+    def switch_stream(self, args):
+        if len(args) < 1:
+            msg = "Ant {}: Stream needs an argument: start [rate] | stop | dump [seconds]".format(self.ant_num)
+            self.log_msg_q.put((log.ERROR, MODULE, msg))
+            return msg
+        action = args[0]
+        level = log.INFO
+        if action == 'start':
+            if self.stream is not None:
+                msg = "Ant {}: Already streaming".format(self.ant_num)
+            else:
+                rate = float(args[1]) if len(args) > 1 and is_number(args[1]) else STREAM_RATE
+                # A stream that was just stopped may not have stopped the device's streaming yet
+                self.join_stream()
+                # Summaries have their own source, since their monitor points differ from the antenna's
+                self.stream = AinStream(self.lj_handle, "ant{}-stream".format(self.ant_num),
+                                        stream_channels(STREAM_MPS), self.log_msg_q, self.mp_q, rate)
+                self.stream_thread = Thread(target=self.stream.run, name='Stream-{}'.format(self.ant_num))
+                self.stream_thread.start()
+                msg = "Ant {}: Starting stream at {} Hz".format(self.ant_num, rate)
+        elif action == 'stop':
+            if self.stream is not None:
+                self.stream.stop = True
+                self.stream = None
+            msg = "Ant {}: Stopping stream".format(self.ant_num)
+        elif action == 'dump' and self.stream is not None:
+            seconds = float(args[1]) if len(args) > 1 and is_number(args[1]) else STREAM_DUMP_SECONDS
+            file_name = "ant{}-stream-{:.6f}.npz".format(self.ant_num, hwmc_time.mjd())
+            num_scans = self.stream.dump(seconds, file_name)
+            msg = "Ant {}: Wrote {} scans to {}".format(self.ant_num, num_scans, file_name)
+        else:
+            msg = "Ant {}: Invalid stream request: {}".format(self.ant_num, ' '.join(args))
+            self.log_msg_q.put((log.ERROR, MODULE, msg))
+            return msg
+        self.log_msg_q.put((level, MODULE, msg))
+
+    def join_stream(self):
+        # Wait for the last stream started to finish, once it has been asked to stop
+        if self.stream_thread is not None:
+            self.stream_thread.join()
+            self.stream_thread = None
+
     def ctrl_antenna_motor(self, state):
         if state in DRIVE_BITS:
             bits = DRIVE_BITS[state]
             ljm.eWriteNameArray(self.lj_handle, port.DRIVE, len(bits), bits)
 
+    def read_el(self):
+        # Elevation from a single encoder read, for the control loop
+        return convert_encoder(ljm.eReadName(self.lj_handle, port.ENCODER))
+
+    def step(self):
+        # Advance the move in progress by one control step
+        move = self.move
+        if move is None:
+            return
+        direction = move.step(self.read_el())
+        if direction is None:
+            self._end_move(move.error)
+        elif direction != self.drive:
+            self.ctrl_antenna_motor(direction)
+            self.drive = direction
+
+    def _end_move(self, error):
+        # Stop the drive and apply the brake, then report the outcome of the move in progress, if any, even if
+        # stopping failed
+        move = self.move
+        self.move = None
+        stopped = False
+        try:
+            self.ctrl_antenna_motor(OFF)
+            self.drive = OFF
+            self.switch_brake('on')
+            stopped = True
+        finally:
+            if not stopped:
+                error = "{}; unable to stop the drive".format(error or "Elevation acquired")
+            if move is not None:
+                if error is None:
+                    self.log_msg_q.put((log.INFO, MODULE, "Ant {}: Elevation acquired".format(self.ant_num)))
+                else:
+                    self.log_msg_q.put((log.ERROR, MODULE, "Ant {}: {}".format(self.ant_num, error)))
+                if move.done is not None:
+                    move.done(self.ant_num, error)
+
     def move_ant(self, pos):
         if len(pos) != 1:
             msg = "Ant {}: Move needs one argument: <target angle in deg> | up | down | stop".format(self.ant_num)
             self.log_msg_q.put((log.ERROR, MODULE, msg))
-            return
+            return msg
         pos = pos[0]
+        if not is_number(pos) and pos not in ('up', 'down', 'stop', 'off'):
+            msg = "Ant {} Invalid argument for 'move': {}. Should be [up|down|stop|<angle>"\
+                .format(self.ant_num, pos)
+            self.log_msg_q.put((log.ERROR, MODULE, msg))
+            return msg
+        if self.move is not None:
+            # A new valid move command always ends the move in progress
+            self._end_move("Move preempted by 'move {}'".format(pos))
         if is_number(pos):
             pos = float(pos)
             msg = "Ant {}: Moving antenna to {} deg elevation".format(self.ant_num, pos)
             self.log_msg_q.put((log.INFO, MODULE, msg))
-            self.move_time = abs(self.monitor_points['ant_el'] - pos)/ DRIVE_RATE
-            self.stop_time = time.time() + TIMEOUT
-            err = 0.0
+            # The move continues in step(), which reports the outcome when it ends
+            self.move = ElevationMove(pos, self.read_el(), self._take_done())
             self.switch_brake('off')
-            while time.time() < self.stop_time:
-                err = pos - self.monitor_points['ant_el']
-                if abs(err) > ACQ_WINDOW:
-                    if err > 0:
-                        self.ctrl_antenna_motor(UP)
-                    else:
-                        self.ctrl_antenna_motor(DOWN)
-                    time.sleep(0.1)
-                    self.get_data()
-                else:
-                    break
-            self.ctrl_antenna_motor(OFF)
-            self.switch_brake('on')
-            if abs(err) > ACQ_WINDOW:
-                msg = "Ant {}: Move timed out".format(self.ant_num)
-            else:
-                msg = "Ant {}: Elevation acquired".format(self.ant_num)
-
-            self.log_msg_q.put((log.ERROR, MODULE, msg))
+            self.step()
         else:
             if pos == 'up':
                 self.switch_brake('off')
                 msg = "Ant {}: Moving up".format(self.ant_num)
                 self.ctrl_antenna_motor(UP)
+                self.drive = UP
             elif pos == 'down':
                 self.switch_brake('off')
                 msg = "Ant {}: Moving down".format(self.ant_num)
                 self.ctrl_antenna_motor(DOWN)
-            elif pos == 'stop' or pos == 'off':
+                self.drive = DOWN
+            else:
                 msg = "Ant {}: Stopping".format(self.ant_num)
                 self.ctrl_antenna_motor(OFF)
+                self.drive = OFF
                 self.switch_brake('on')
-            else:
-                msg = "Ant {} Invalid argument for 'move': {}. Should be [up|down|stop|<angle>"\
-                    .format(self.ant_num, pos)
             self.log_msg_q.put((log.INFO, MODULE, msg))
 
     def write_mp_data(self, filename, timestamp, ant_num, mp_data, first=False, append=False):
@@ -337,43 +672,57 @@ class DsaAntLabjack:
         data_file.close()
 
 
+def stream_channels(mps):
+    # Stream channel list (monitor point, AIN number, scale, offset) for the named monitor points
+    cal = {'ant_el': (ENCODER_INDEX, encoder.SCALE_FACTOR, encoder.OFFSET)}
+    for mp, index, scale, offset in AIN_CAL:
+        cal[mp] = (index, scale, offset)
+    return [(mp,) + cal[mp] for mp in mps]
+
+
 def is_number(s):
+    # True for a finite number; 'nan' and 'inf' are not accepted as elevations, rates or times
     try:
-        float(s)
-        return True
+        return math.isfinite(float(s))
     except ValueError:
         return False
 
 
 # -------------- LabJack analog backend class ------------------
 
+# Analog backend monitor points and their initial values
+ABE_MPS = [('drive_state', 0),  # 0 = off, 1 = up, 2 = down
+           ('brake', 0),        # 0 = off, 1 = on
+           ('plus_limit', 0),
+           ('minus_limit', 0),
+           ('ant_el', 0.0),
+           ('foc_temp', -273.15),
+           ('rf_a_power', -100.0),
+           ('rf_b_power', -100.0),
+           ('laser_a_current', 0.0),
+           ('laser_b_current', 0.0),
+           ('laser_a_opt_power', 0.0),
+           ('laser_b_opt_power', 0.0),
+           ('psu_a_volt', 0.0),
+           ('psu_b_volt', 0.0),
+           ('box_temp', -273.15)]
+ABE_SCHEMA = MpSchema([mp[0] for mp in ABE_MPS], [mp[1] for mp in ABE_MPS])
+
+# Every monitor point the LabJacks post: antennas, analog backends and stream summaries
+MP_NAMES = list(dict.fromkeys(ANT_SCHEMA.names + ABE_SCHEMA.names + tuple(lj_stream.summary_names(STREAM_MPS))))
+
+
 class DsaAbeLabjack:
-    def __init__(self, device_type, connection_type, serial_number, mp_q):
+    def __init__(self, lj_handle, abe_num, log_msg_q, mp_q):
         self.valid = False
+        self.lj_handle = lj_handle
+        self.abe_num = abe_num
+        self.log_msg_q = log_msg_q
         self.mp_q = mp_q
-        self.monitor_points = {'drive_state': 0,  # 0 = off, 1 = up, 2 = down
-                               'brake': 0,  # 0 = off, 1 = on
-                               'plus_limit': 0,
-                               'minus_limit': 0,
-                               'ant_el': 0.0,
-                               'foc_temp': -273.15,
-                               'rf_a_power': -100.0,
-                               'rf_b_power': -100.0,
-                               'laser_a_current': 0.0,
-                               'laser_b_current': 0.0,
-                               'laser_a_opt_power': 0.0,
-                               'laser_b_opt_power': 0.0,
-                               'psu_a_volt': 0.0,
-                               'psu_b_volt': 0.0,
-                               'box_temp': -273.15}
-        # Open a LabJack
-        try:
-            self.lj_handle = ljm.open(device_type, connection_type, serial_number)
-        except ljm.LJMError:
-            self.valid = False
-            return  # To be replaced with a raise exception?
+        self.mp_values = list(ABE_SCHEMA.defaults)
+        self.monitor_points = ABE_SCHEMA.record()
         self.valid = True
-        print("Hello from analog backend")
+        self.log_msg_q.put((log.INFO, MODULE, "Analog backend {} connected".format(self.abe_num)))
 
     def __del__(self):
         if self.valid is True:
@@ -383,5 +732,6 @@ class DsaAbeLabjack:
     def get_data(self):
         if self.valid is True:
             analog_vals = ljm.eReadNameArray(self.lj_handle, "AIN0", 9)
-            self.monitor_points['ant_el'] = convert_encoder(analog_vals[0])
+            self.mp_values[ABE_SCHEMA.index['ant_el']] = convert_encoder(analog_vals[0])
+            self.monitor_points = MpRecord(ABE_SCHEMA, self.mp_values)
         return self.monitor_points
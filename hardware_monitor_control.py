@@ -1,97 +1,147 @@
+import time
+T_START = time.perf_counter()   # Start of the imports, for --profile-startup
+import argparse
+import functools
+import queue
+import os
+from threading import Thread
 import hwmc_logging as log
 import commands as cmds
 import dsa_labjack as dlj
-import time
-from threading import Thread
-import threading
-import queue
 import hw_monitor as mon
-import os
 from monitor_server import MpServer
+from server_loop import ServerLoop
+from acq_scheduler import AcqScheduler
+import hwmc_stats as stats
+from hwmc_startup import StartupProfile
 
 MODULE = os.path.basename(__file__)
 
 # Set up some parameters to control execution, memory allocation, and logging
 
 SIM = False     # Simulation mode of LabJacks
+SIM_ANTS = dlj.NUM_SIM  # Number of simulated antennas in simulation mode
+
+SCHEDULER = True    # Poll antennas from a shared worker pool rather than one thread per antenna
+ACQ_WORKERS = 8     # Size of the worker pool used by the scheduler
+
+MP_STORE = mon.STORE_TEXT   # Monitor point file format: STORE_TEXT, STORE_BINARY or STORE_BOTH
 
 ANT_CMD_Q_DEPTH = 5
 
-log_level = log.INFO
-
-# --------- Start main script ------------
-thread_count = 1    # This starts with main thread
-
-# Start logging
-logfile_prefix = "dsa-110-test-"
-log_msg_q = queue.Queue()
-level = log.ALL
-hw_log = log.HwmcLog(logfile_prefix, log_msg_q, level)
-log_thread = Thread(target=hw_log.logging_thread)
-log_thread.start()
-thread_count += 1
-
-# Start monitor point queue
-mp_q = mon.Monitor_q("dsa-110-test-", log_msg_q)
-monitor_thread = Thread(target=mp_q.run, name='mp_q-thread')
-monitor_thread.start()
-thread_count += 1
-
-# Create the TCP/IP server and start its thread
-mp_server = MpServer(mp_q, log_msg_q)
-server_thread = Thread(target=mp_server.run_server, name='server_thread')
-server_thread.start()
-thread_count += 1
-
-# Discover LabJack T7 devices on the network
-devices = dlj.LabjackList(log_msg_q, mp_q, simulate=SIM)
-ants = devices.ants
-abes = devices.abes
-
-# Set up a command queue for each antenna, these should not be deep, since there is no use case for sending multiple
-# commands in rapid succession
-ant_cmd_qs = {}
-for ant_num, ant in ants.items():
-    ant_cmd_qs[ant_num] = queue.Queue(ANT_CMD_Q_DEPTH)
-    ants[ant_num].cmd_q = ant_cmd_qs[ant_num]
-
-# Start running antenna control and monitor threads
-for ant_num, ant in ants.items():
-    t = Thread(target=ant.run, name='Ant-{}'.format(ant_num))
-    t.start()
-    thread_count += 1
-
-# Start the command processor and command server
-print("Waiting for threads to start")
-while threading.activeCount() < thread_count:
-    time.sleep(0.5)
-print("Starting command processor")
-cmd = cmds.HwmcCommands(ant_cmd_qs, log_msg_q)
-cmd_thread = Thread(target=cmd.command_thread, name='cmd-thread')
-cmd_thread.start()
-cmd_server_thread = Thread(target=cmd.command_server_thread, name='cmd-server-thread')
-cmd_server_thread.start()
-thread_count += 2
-
-while not cmd.stop_request:
-    time.sleep(0.1)
-cmd.stop = True
-
-print("Stopping threads ", end='')
-for ant_num, ant in ants.items():
-    ant.stop = True
-    print(".", end='')
-time.sleep(2)
-
-mp_server.stop = True
-time.sleep(2)
-mp_q.stop = True
-time.sleep(2)
-hw_log.stop = True
-
-while threading.activeCount() > 1:
-    print(".", end='')
-    time.sleep(1.0)
-
-print("\nFinished")
-exit(0)
+FILE_PREFIX = "dsa-110-test-"   # Log and monitor point files are this followed by the UT date
+log_level = log.ALL
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DSA-110 antenna hardware monitor and control")
+    parser.add_argument('--simulate', type=int, nargs='?', const=SIM_ANTS, default=SIM_ANTS if SIM else None,
+                        metavar='ANTS', help="use simulated LabJacks, {} unless a number is given".format(SIM_ANTS))
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print the time taken by each phase of start up")
+    parser.add_argument('--group', action='append', default=[], metavar='NAME=TARGETS',
+                        help="define a named group of antennas for commands, e.g. west_arm=1-20; may be repeated")
+    args = parser.parse_args()
+    try:
+        groups = cmds.parse_groups(args.group)
+    except ValueError as e:
+        parser.error(str(e))
+    profile = StartupProfile(T_START)
+    profile.mark('imports')
+
+    # Start logging
+    log_msg_q = queue.Queue()
+    hw_log = log.HwmcLog(FILE_PREFIX, log_msg_q, log_level)
+    log_thread = Thread(target=hw_log.logging_thread, name='log-thread')
+    log_thread.start()
+    profile.mark('logging')
+
+    # Start monitor point queue
+    mp_q = mon.Monitor_q(FILE_PREFIX, log_msg_q, MP_STORE, dlj.MP_NAMES + stats.point_names())
+    monitor_thread = Thread(target=mp_q.run, name='mp_q-thread')
+    monitor_thread.start()
+    profile.mark('monitor queue')
+
+    # Publish the pipeline's own statistics as monitor points
+    stats_publisher = stats.StatsPublisher(mp_q, log_msg_q)
+    stats_thread = Thread(target=stats_publisher.run, name='stats-thread')
+    stats_thread.start()
+
+    # Create the monitor point server. It runs on the server loop, which is started with the command server.
+    mp_server = MpServer(mp_q, log_msg_q)
+    server_loop = ServerLoop(log_msg_q)
+    server_loop.add(mp_server)
+    profile.mark('monitor server')
+
+    # Discover LabJack T7 devices on the network
+    devices = dlj.LabjackList(log_msg_q, mp_q, simulate=args.simulate is not None,
+                              num_sim=args.simulate or SIM_ANTS)
+    ants = devices.ants
+    profile.mark('discovery')
+
+    # Set up a command queue for each antenna, these should not be deep, since there is no use case for sending
+    # multiple commands in rapid succession
+    ant_cmd_qs = {}
+    for ant_num, ant in ants.items():
+        ant_cmd_qs[ant_num] = cmds.CommandQueue(ANT_CMD_Q_DEPTH)
+        ants[ant_num].cmd_q = ant_cmd_qs[ant_num]
+
+    # Start running antenna control and monitor threads
+    scheduler = None
+    acq_threads = []
+    if SCHEDULER:
+        scheduler = AcqScheduler(ants, log_msg_q, dlj.POLLING_INTERVAL, ACQ_WORKERS)
+        # Commands are executed as soon as they are queued rather than at the antenna's next polling slot
+        for ant_num, q in ant_cmd_qs.items():
+            q.listener = functools.partial(scheduler.wake, ant_num)
+        acq_threads.append(Thread(target=scheduler.run, name='acq-scheduler'))
+    else:
+        for ant_num, ant in ants.items():
+            acq_threads.append(Thread(target=ant.run, name='Ant-{}'.format(ant_num)))
+    for t in acq_threads:
+        t.start()
+    profile.mark('acquisition')
+
+    # Start the command processor and command server
+    print("Starting command processor")
+    cmd = cmds.HwmcCommands(ant_cmd_qs, log_msg_q, groups)
+    server_loop.add(cmd)
+    server_thread = Thread(target=server_loop.run, name='server-thread')
+    server_thread.start()
+    profile.mark('command server')
+    log_msg_q.put((log.INFO, MODULE, "Started in {:.3f} s".format(profile.t_last - profile.t_start)))
+    if args.profile_startup:
+        print(profile.report())
+    cmd_thread = Thread(target=cmd.command_thread, name='cmd-thread')
+    cmd_thread.start()
+
+    while not cmd.stop_request:
+        time.sleep(0.1)
+    cmd.stop = True
+
+    # Stop each stage after the ones that feed it, waiting for it to finish
+    print("Stopping threads")
+    if scheduler is not None:
+        scheduler.stop = True
+    for ant in ants.values():
+        ant.stop = True
+        if ant.stream is not None:
+            ant.stream.stop = True
+    for t in acq_threads:
+        t.join()
+    for ant in ants.values():
+        ant.join_stream()
+    server_loop.stop()
+    server_thread.join()
+    stats_publisher.stop = True
+    stats_thread.join()
+    mp_q.stop = True
+    monitor_thread.join()
+    cmd_thread.join()
+    hw_log.stop = True
+    log_thread.join()
+    print("Finished")
+
+
+if __name__ == '__main__':
+    main()
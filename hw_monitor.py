@@ -1,56 +1,221 @@
 import queue
+import threading
 import time
 import os
-import astropy.time
+import hwmc_time
 import hwmc_logging as log
+import hwmc_stats as stats
+from mp_store import MpStore
+from mp_index import MpIndex, index_name
+from mp_compress import Compressor
 
 MODULE = os.path.basename(__file__)
 
+SECONDS_PER_DAY = 86400
+
+IN_Q_DEPTH = 4096       # Packets waiting to be written; beyond this only the latest packet per source is kept
+OUT_Q_DEPTH = 8192      # Packets waiting for the monitor server; the oldest are dropped when full
+MAX_BATCH = 1024        # Maximum number of packets written in one pass
+FLUSH_INTERVAL = 0.1    # Longest time to wait for new packets before flushing the file
+REPORT_INTERVAL = 60    # Minimum time between warnings about dropped packets
+
+# Storage formats for monitor points
+STORE_TEXT = 'text'      # Text lines of timestamp,source,mp,value in a .mp file
+STORE_BINARY = 'binary'  # Fixed-width binary records in a .mpb file, see mp_store
+STORE_BOTH = 'both'
+
+# Time taken to write each batch of packets, published by hwmc_stats
+WRITE_TIME = stats.histogram('mq_write')
+
 class Monitor_q():
-    def __init__(self, file_prefix, log_msg_q):
+    def __init__(self, file_prefix, log_msg_q, store=STORE_TEXT, points=()):
         self.stop = False
-        self.mon_q_in = queue.Queue()
-        self.mon_q_out = queue.Queue()
+        self.store = store
+        # Monitor points known in advance, each given a column of the binary store
+        self.points = points
+        self.mf = None
+        self.mf_name = None
+        self.mf_offset = 0
+        self.mp_index = None
+        self.mp_store = None
+        self.mon_q_in = queue.Queue(IN_Q_DEPTH)
+        self.mon_q_out = queue.Queue(OUT_Q_DEPTH)
+        # Called by the writer thread after new packets are queued for the server
+        self.notify = None
         self.file_prefix = file_prefix
         self.log_msg_q = log_msg_q
+        # Latest packet from each source that did not fit in mon_q_in
+        self._overflow = {}
+        self._overflow_lock = threading.Lock()
+        self.written = 0
+        self.coalesced = 0
+        self.out_dropped = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
         if not self._open_mp_file():
             raise FileNotFoundError
+        # Closed text files are compressed in the background, including any left over from earlier runs
+        self.compressor = Compressor(log_msg_q)
+        if self.mf is not None:
+            self.compressor.submit_old(self.file_prefix + '????-??-??.mp', self.mf_name)
 
     def post(self, mp):
-        self.mon_q_in.put(mp)
+        try:
+            self.mon_q_in.put_nowait(mp)
+        except queue.Full:
+            # Fall back to keeping only the most recent packet from each source until the writer catches up
+            with self._overflow_lock:
+                if mp[1] in self._overflow:
+                    self.coalesced += 1
+                self._overflow[mp[1]] = mp
 
     def get(self):
         msg = self.mon_q_out.get()
         self.mon_q_out.task_done()
         return msg
 
+    def get_all(self, max_items):
+        # Everything waiting for the server, up to max_items packets, without blocking
+        items = []
+        try:
+            while len(items) < max_items:
+                items.append(self.mon_q_out.get_nowait())
+        except queue.Empty:
+            pass
+        return items
+
     def empty(self):
         return self.mon_q_out.empty()
 
+    def stats(self):
+        return {'in_depth': self.mon_q_in.qsize() + len(self._overflow),
+                'out_depth': self.mon_q_out.qsize(),
+                'written': self.written,
+                'coalesced': self.coalesced,
+                'out_dropped': self.out_dropped,
+                'lag': self.lag,
+                'max_lag': self.max_lag}
+
     def run(self):
+        last_report = time.time()
+        reported_drops = 0
         while not self.stop:
-            if not self.mon_q_in.empty():
-                item = self.mon_q_in.get()
-                self.mon_q_in.task_done()
-                timestamp, source, mp_packet = item
-                for mp in mp_packet:
-                    self.mf.write("{},{},{},{}\n".format(timestamp, source, mp, mp_packet[mp]))
-                    self.mon_q_out.put("{},{},{},{}\n".format(timestamp, source, mp, mp_packet[mp]).encode('ascii'))
-            self.mf.flush()
-            if astropy.time.Time.now().iso[: 10] != self.file_date:
-                self.mf.close()
+            batch = self._get_batch(FLUSH_INTERVAL)
+            if batch:
+                self._write_batch(batch)
+            self._flush()
+            if hwmc_time.day() != self.file_day:
+                closed_name = self.mf_name
+                self._close_mp_file()
                 self._open_mp_file()
-            time.sleep(0.1)
+                if closed_name is not None:
+                    self.compressor.submit(closed_name)
+            self.compressor.poll()
+            drops = self.coalesced + self.out_dropped
+            if drops != reported_drops and time.time() - last_report > REPORT_INTERVAL:
+                self.log_msg_q.put((log.WARN, MODULE, "Monitor queue falling behind: {} packets coalesced, {} "
+                                                      "packets dropped for server, lag {:.2f} s"
+                                    .format(self.coalesced, self.out_dropped, self.lag)))
+                reported_drops = drops
+                last_report = time.time()
+        # Write out whatever is left before closing
+        batch = self._get_batch(0)
+        while batch:
+            self._write_batch(batch)
+            batch = self._get_batch(0)
+        self._close_mp_file()
+
+    def _get_batch(self, timeout):
+        # Wait up to timeout for a packet, then take everything else that is already waiting
+        batch = []
+        try:
+            if timeout > 0:
+                batch.append(self.mon_q_in.get(timeout=timeout))
+            while len(batch) < MAX_BATCH:
+                batch.append(self.mon_q_in.get_nowait())
+        except queue.Empty:
+            pass
+        if self._overflow:
+            with self._overflow_lock:
+                overflow = self._overflow
+                self._overflow = {}
+            batch.extend(overflow.values())
+        return batch
+
+    def _write_batch(self, batch):
+        t_start = time.perf_counter()
+        if self.mf is not None:
+            packets = []
+            index_entries = []
+            offset = self.mf_offset
+            for timestamp, source, mp_packet in batch:
+                packets.append(''.join(["{},{},{},{}\n".format(timestamp, source, mp, val)
+                                        for mp, val in mp_packet.items()]))
+                index_entries.append((timestamp, source, offset, len(packets[-1])))
+                offset += len(packets[-1])
+            self.mf.write(''.join(packets))
+            self.mf_offset = offset
+            self.mp_index.add(index_entries)
+        if self.mp_store is not None:
+            self.mp_store.write(batch)
+        for item in batch:
+            self._put_out(item)
+        notify = self.notify
+        if notify is not None:
+            notify()
+        self.written += len(batch)
+        WRITE_TIME.record(time.perf_counter() - t_start)
+        self.lag = (hwmc_time.mjd() - min(item[0] for item in batch)) * SECONDS_PER_DAY
+        self.max_lag = max(self.max_lag, self.lag)
+
+    def _put_out(self, item):
+        # Drop the oldest waiting message rather than block the writer when the server is not keeping up
+        try:
+            self.mon_q_out.put_nowait(item)
+        except queue.Full:
+            try:
+                self.mon_q_out.get_nowait()
+            except queue.Empty:
+                pass
+            self.out_dropped += 1
+            self.mon_q_out.put_nowait(item)
 
     def _open_mp_file(self):
-        ut = astropy.time.Time.now().iso
-        self.file_date = ut[: 10]
-        mp_file_name =self.file_prefix + self.file_date + '.mp'
+        self.file_day = hwmc_time.day()
+        self.file_date = hwmc_time.date(self.file_day)
+        mp_file_name = self.file_prefix + self.file_date + '.mp'
         try:
-            self.mf = open(mp_file_name, 'a')
-            self.log_msg_q.put((log.INFO, MODULE, "Opening mp storage file: {}".format(mp_file_name)))
+            if self.store in (STORE_TEXT, STORE_BOTH):
+                # No newline translation, so that index offsets are byte offsets on every platform
+                self.mf = open(mp_file_name, 'a', newline='\n')
+                self.mf_name = mp_file_name
+                self.mf_offset = self.mf.seek(0, os.SEEK_END)
+                self.mp_index = MpIndex(index_name(mp_file_name))
+                self.log_msg_q.put((log.INFO, MODULE, "Opening mp storage file: {}".format(mp_file_name)))
+            if self.store in (STORE_BINARY, STORE_BOTH):
+                mp_file_name += 'b'
+                self.mp_store = MpStore(mp_file_name, self.file_date, self.log_msg_q, self.points)
+                self.log_msg_q.put((log.INFO, MODULE, "Opening binary mp storage file: {}".format(mp_file_name)))
             succeed = True
-        except OSError as e:
+        except (OSError, ValueError) as e:
             print("Error {} opening file '{}'".format(e, mp_file_name))
             succeed = False
-        return succeed
\ No newline at end of file
+        return succeed
+
+    def _flush(self):
+        if self.mf is not None:
+            self.mf.flush()
+            self.mp_index.flush()
+        if self.mp_store is not None:
+            self.mp_store.flush()
+
+    def _close_mp_file(self):
+        if self.mf is not None:
+            self.mf.close()
+            self.mf = None
+            self.mf_name = None
+            self.mp_index.close()
+            self.mp_index = None
+        if self.mp_store is not None:
+            self.mp_store.close()
+            self.mp_store = None
@@ -1,4 +1,4 @@
-import astropy.time
+import hwmc_time
 import time
 import os
 
@@ -37,36 +37,45 @@ class HwmcLog:
         self.log_prefix = log_prefix
         if not self._open_log_file():
             raise FileNotFoundError
+        # Closed log files are compressed in the background, including any left over from earlier runs. mp_compress
+        # logs through this module, so it is imported here rather than at the top to avoid a circular import
+        import mp_compress
+        self.compressor = mp_compress.Compressor(log_msg_q)
+        self.compressor.submit_old(self.log_prefix + '????-??-??.log', self.logfile_name)
 
     def logging_thread(self):
         while not self.stop:
             while not self.log_msg_q.empty():
                 (level, module, msg) = self.log_msg_q.get()
                 if level >= self.logging_level:
-                    ut = astropy.time.Time.now().iso
+                    ut = hwmc_time.iso()
                     if level not in level_str:
                         level = FATAL
                     self.lf.write("[{0}]{{{1}}}|{2}|{3}\n".format(ut, level_str[level], module, msg))
             self.lf.flush()
             # Check to see if UT date has rolled over
-            if astropy.time.Time.now().iso[: 10] != self.file_date:
+            if hwmc_time.day() != self.file_day:
                 self.lf.close()
+                self.compressor.submit(self.logfile_name)
                 if not self._open_log_file():
                     raise FileNotFoundError
+            self.compressor.poll()
             # Don't hog resources
             time.sleep(0.1)
 
-        ut = astropy.time.Time.now().iso
+        ut = hwmc_time.iso()
         self.lf.write("[{0}]{{{1}}}|{2}|{3}\n".format(ut, level_str[INFO], MODULE, "Stopping logging"))
         self.lf.close()
         return
 
     def _open_log_file(self):
-        ut = astropy.time.Time.now().iso
-        self.file_date = ut[: 10]
+        ut = hwmc_time.iso()
+        self.file_day = hwmc_time.day()
+        self.file_date = hwmc_time.date(self.file_day)
         logfile_name =self.log_prefix + self.file_date + '.log'
         try:
             self.lf = open(logfile_name, 'a')
+            self.logfile_name = logfile_name
             self.lf.write("[{0}]{{{1}}}|{2}|{3}\n".format(ut, level_str[INFO], MODULE, "Starting logging"))
             succeed = True
         except OSError as e:
@@ -0,0 +1,33 @@
+import time
+
+# Timing of the phases of a program's start up, reported by the --profile-startup option of the entry points
+
+
+class StartupProfile:
+    '''Records how long each phase of start up took'''
+    def __init__(self, t_start):
+        '''Start profiling
+
+        Arguments
+        t_start -- time.perf_counter() when the program started, normally taken before its imports
+        '''
+        self.t_start = t_start
+        self.t_last = t_start
+        self.phases = []
+
+    def mark(self, phase):
+        # End a phase, which started when the previous one ended
+        t = time.perf_counter()
+        self.phases.append((phase, t - self.t_last))
+        self.t_last = t
+
+    def skip(self):
+        # Leave the time since the last phase out of the profile, e.g. time waiting for the user
+        t = time.perf_counter()
+        self.t_start += t - self.t_last
+        self.t_last = t
+
+    def report(self):
+        lines = ["{:24} {:8.3f} s".format(phase, seconds) for phase, seconds in self.phases]
+        lines.append("{:24} {:8.3f} s".format('total', self.t_last - self.t_start))
+        return '\n'.join(lines)
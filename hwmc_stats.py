@@ -0,0 +1,160 @@
+import bisect
+import math
+import threading
+import time
+import os
+import hwmc_time
+import hwmc_logging as log
+from mp_record import MpSchema, MpRecord
+
+MODULE = os.path.basename(__file__)
+
+# The pipeline's own statistics are published as monitor points of this source, so clients can plot them next to
+# antenna data. No LabJack uses this name.
+SOURCE = 'hwmc'
+PUBLISH_INTERVAL = 1.0  # Time between publications in s; histograms cover the time since the last one
+BUCKETS_PER_DECADE = 10
+MAX_SLEEP = 0.1         # Longest the publisher sleeps at once, so that it notices a stop request promptly
+
+# Queue statistics published with the registered histograms and gauges
+QUEUE_POINTS = ['mq_in_depth', 'mq_out_depth', 'mq_lag', 'mq_coalesced', 'mq_out_dropped', 'log_depth']
+
+
+class Histogram:
+    '''Counts of values in log-spaced buckets, cheap enough to record from hot paths'''
+    def __init__(self, low=1e-6, high=100.0):
+        '''Create an empty histogram
+
+        Arguments
+        low, high -- range of the buckets; smaller and larger values are counted in the end buckets
+        '''
+        num_bounds = int(round(math.log10(high / low) * BUCKETS_PER_DECADE)) + 1
+        self.bounds = [low * 10 ** (i / BUCKETS_PER_DECADE) for i in range(num_bounds)]
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            if value > self.max:
+                self.max = value
+
+    def take(self):
+        # Returns (count, median, 99th percentile, maximum) of the values recorded since the last take, and clears
+        # the histogram. Percentiles are the upper bounds of their buckets.
+        with self._lock:
+            counts, count, max_value = self.counts, self.count, self.max
+            self._clear()
+        return (count, self._percentile(counts, count, max_value, 0.5),
+                self._percentile(counts, count, max_value, 0.99), max_value)
+
+    def _percentile(self, counts, count, max_value, p):
+        total = 0
+        for i, n in enumerate(counts):
+            total += n
+            if total >= p * count and n:
+                return min(self.bounds[i], max_value) if i < len(self.bounds) else max_value
+        return 0.0
+
+
+# Histograms and gauges published by StatsPublisher, registered by the modules they measure. Registrations can come
+# and go while the publisher runs, so they are changed and read under the lock.
+histograms = {}
+gauges = {}
+_lock = threading.Lock()
+
+
+def histogram(name, low=1e-6, high=100.0):
+    # The histogram published as <name>_p50, <name>_p99 and <name>_max, created on first use
+    hist = histograms.get(name)
+    if hist is None:
+        with _lock:
+            hist = histograms.setdefault(name, Histogram(low, high))
+    return hist
+
+
+def gauge(name, read):
+    # read() is called at each publication and its result published as monitor point name
+    with _lock:
+        gauges[name] = read
+
+
+def remove(name):
+    # Stop publishing a histogram or gauge, e.g. one that measured a client that has gone
+    with _lock:
+        histograms.pop(name, None)
+        gauges.pop(name, None)
+
+
+def _registered():
+    with _lock:
+        return sorted(histograms.items()), sorted(gauges.items())
+
+
+def point_names():
+    # Monitor points published for the histograms and gauges registered so far
+    hists, reads = _registered()
+    names = list(QUEUE_POINTS)
+    for name, _ in hists:
+        names += [name + '_p50', name + '_p99', name + '_max']
+    return names + [name for name, _ in reads]
+
+
+class StatsPublisher:
+    '''Posts the registered histograms and gauges to the monitor queue as one packet per interval'''
+    def __init__(self, mp_q, log_msg_q, interval=PUBLISH_INTERVAL):
+        '''Create a publisher. The monitor and log queue depths are always published.
+
+        Arguments
+        mp_q -- Monitor_q object the statistics are posted to, and whose own statistics are published
+        log_msg_q -- a Queue object for logging messages
+        interval -- time between publications in s
+        '''
+        self.stop = False
+        self.mp_q = mp_q
+        self.log_msg_q = log_msg_q
+        self.interval = interval
+        self.schema = None
+
+    def run(self):
+        self.log_msg_q.put((log.INFO, MODULE, "Publishing pipeline statistics as source '{}'".format(SOURCE)))
+        next_publish = time.time() + self.interval
+        while not self.stop:
+            t = time.time()
+            if t < next_publish:
+                time.sleep(min(next_publish - t, MAX_SLEEP))
+                continue
+            next_publish += self.interval
+            if next_publish <= t:
+                next_publish = t + self.interval
+            self.publish()
+
+    def publish(self):
+        mp_stats = self.mp_q.stats()
+        names = list(QUEUE_POINTS)
+        values = [mp_stats['in_depth'], mp_stats['out_depth'], mp_stats['lag'], mp_stats['coalesced'],
+                  mp_stats['out_dropped'], self.log_msg_q.qsize()]
+        hists, reads = _registered()
+        for name, hist in hists:
+            _, p50, p99, max_value = hist.take()
+            names += [name + '_p50', name + '_p99', name + '_max']
+            values += [p50, p99, max_value]
+        for name, read in reads:
+            names.append(name)
+            try:
+                values.append(read())
+            except Exception as e:
+                values.append(float('nan'))
+                self.log_msg_q.put((log.WARN, MODULE, "Unable to read statistic {}: {}".format(name, e)))
+        # The schema only changes when statistics are registered or removed
+        if self.schema is None or self.schema.names != tuple(names):
+            self.schema = MpSchema(names)
+        ts = hwmc_time.mjd()
+        self.mp_q.post((ts, SOURCE, MpRecord(self.schema, values)))
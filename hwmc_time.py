@@ -0,0 +1,66 @@
+import time
+
+# UT clock shared by the hot paths, computed from the system clock with integer arithmetic instead of
+# astropy.time.Time, which costs tens of microseconds per call. Times are UTC like Time.now(), with the system
+# clock's treatment of leap seconds. test_hwmc_time.py checks it against astropy; run this module to compare their
+# cost.
+
+SECONDS_PER_DAY = 86400
+NS_PER_DAY = SECONDS_PER_DAY * 10 ** 9
+MS_PER_DAY = SECONDS_PER_DAY * 1000
+MJD_UNIX_EPOCH = 40587  # MJD of 1970-01-01
+
+# ISO dates of the MJD days seen so far
+_dates = {}
+
+
+def mjd(t=None):
+    # MJD of a time.time() value, or of now
+    if t is None:
+        day, ns = divmod(time.time_ns(), NS_PER_DAY)
+        return MJD_UNIX_EPOCH + day + ns / NS_PER_DAY
+    return MJD_UNIX_EPOCH + t / SECONDS_PER_DAY
+
+
+def day(t=None):
+    # Integer MJD of the UT day of a time.time() value, or of now; compare these to detect a change of day
+    if t is None:
+        return MJD_UNIX_EPOCH + time.time_ns() // NS_PER_DAY
+    return MJD_UNIX_EPOCH + int(t // SECONDS_PER_DAY)
+
+
+def date(mjd_day):
+    # 'YYYY-MM-DD' of an integer MJD day
+    iso_date = _dates.get(mjd_day)
+    if iso_date is None:
+        iso_date = time.strftime('%Y-%m-%d', time.gmtime((mjd_day - MJD_UNIX_EPOCH) * SECONDS_PER_DAY))
+        _dates[mjd_day] = iso_date
+    return iso_date
+
+
+def iso(t=None):
+    # 'YYYY-MM-DD HH:MM:SS.sss' of a time.time() value, or of now, rounded to the millisecond like Time.iso
+    if t is None:
+        ms = (time.time_ns() + 500000) // 1000000
+    else:
+        ms = round(t * 1000)
+    mjd_day, ms = divmod(ms, MS_PER_DAY)
+    s, ms = divmod(ms, 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return "{} {:02d}:{:02d}:{:02d}.{:03d}".format(date(mjd_day + MJD_UNIX_EPOCH), h, m, s, ms)
+
+
+def _compare_cost():
+    from astropy.time import Time
+    for name, fn in [('hwmc_time.mjd()', mjd), ('hwmc_time.iso()', iso), ('hwmc_time.day()', day),
+                     ('Time.now().mjd', lambda: Time.now().mjd), ('Time.now().iso', lambda: Time.now().iso)]:
+        num_calls = 20000 if name.startswith('hwmc') else 2000
+        t_start = time.perf_counter()
+        for _ in range(num_calls):
+            fn()
+        print("{:16} {:8.2f} us".format(name, 1e6 * (time.perf_counter() - t_start) / num_calls))
+
+
+if __name__ == '__main__':
+    _compare_cost()
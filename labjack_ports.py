@@ -1,4 +1,5 @@
 # Analog ports
+ENCODER = "AIN0"  # Elevation encoder voltage
 
 
 # Digital Ports
@@ -0,0 +1,148 @@
+try:
+    from labjack import ljm
+except ImportError:
+    ljm = None  # Replaced by the simulator; see dsa_labjack.use_simulator()
+import numpy as np
+import threading
+import time
+import os
+import hwmc_time
+import hwmc_logging as log
+from mp_record import MpSchema, MpRecord
+
+MODULE = os.path.basename(__file__)
+
+SECONDS_PER_DAY = 86400
+
+SCAN_RATE = 500         # Default scans per second
+READS_PER_SECOND = 10   # eStreamRead calls per second; sets the number of scans per read
+BUFFER_SECONDS = 60     # Length of full-rate history kept in the ring buffer
+SUMMARY_INTERVAL = 1.0  # Seconds between decimated summaries posted to the monitor queue
+DUMMY_VALUE = -9999.0   # Value LJM substitutes for scans skipped by the device
+
+STREAM_SETUP_NAMES = ["STREAM_TRIGGER_INDEX", "STREAM_CLOCK_SOURCE", "STREAM_SETTLING_US", "STREAM_RESOLUTION_INDEX"]
+STREAM_SETUP_VALUES = [0, 0, 0, 0]
+
+
+def summary_names(mps):
+    # Names of the summary monitor points posted for streamed monitor points mps
+    return [mp + suffix for mp in mps for suffix in ('_min', '_max', '_mean')]
+
+
+class AinStream:
+    '''High-rate streaming of selected analog inputs from a single LabJack'''
+    def __init__(self, lj_handle, source, channels, log_msg_q, mp_q, scan_rate=SCAN_RATE,
+                 buffer_seconds=BUFFER_SECONDS):
+        '''Set up a stream and preallocate its ring buffer
+        Full-rate calibrated data are kept in a ring buffer holding the last buffer_seconds of scans. Once per
+        SUMMARY_INTERVAL the minimum, maximum and mean of each channel are posted to the monitor queue as
+        <mp>_min, <mp>_max and <mp>_mean.
+
+        Arguments
+        lj_handle -- handle of an open LabJack
+        source -- monitor point source of the summaries, e.g. 'ant12-stream'
+        channels -- list of (monitor point, AIN number, scale, offset) for the channels to stream
+        log_msg_q -- a Queue object for logging messages
+        mp_q -- Monitor_q object the summaries are posted to
+        scan_rate -- requested scans per second
+        buffer_seconds -- length of the ring buffer in seconds
+        '''
+        self.stop = False
+        self.lj_handle = lj_handle
+        self.source = source
+        self.log_msg_q = log_msg_q
+        self.mp_q = mp_q
+        self.mps = [c[0] for c in channels]
+        self.ain_names = ["AIN{}".format(c[1]) for c in channels]
+        self.scales = np.array([c[2] for c in channels])
+        self.offsets = np.array([c[3] for c in channels])
+        self.summary_schema = MpSchema(summary_names(self.mps))
+        self.scan_rate = scan_rate
+        self.scans_per_read = max(1, int(scan_rate / READS_PER_SECOND))
+        self.buffer = np.full((int(scan_rate * buffer_seconds), len(channels)), np.nan)
+        self.scan_count = 0
+        self.mjd_start = 0.0
+        self._lock = threading.Lock()
+
+    def run(self):
+        try:
+            addresses = [ljm.nameToAddress(name)[0] for name in self.ain_names]
+            ljm.eWriteNames(self.lj_handle, len(STREAM_SETUP_NAMES), STREAM_SETUP_NAMES, STREAM_SETUP_VALUES)
+            self.scan_rate = ljm.eStreamStart(self.lj_handle, self.scans_per_read, len(addresses), addresses,
+                                              self.scan_rate)
+        except ljm.LJMError as e:
+            self.log_msg_q.put((log.ERROR, MODULE, "{}: Unable to start stream. LJMError: {}".format(self.source, e)))
+            return
+        self.mjd_start = hwmc_time.mjd()
+        self.log_msg_q.put((log.INFO, MODULE, "{}: Streaming {} at {:.1f} Hz"
+                            .format(self.source, ', '.join(self.mps), self.scan_rate)))
+        summary_start = 0
+        next_summary = time.time() + SUMMARY_INTERVAL
+        try:
+            while not self.stop:
+                a_data, device_backlog, ljm_backlog = ljm.eStreamRead(self.lj_handle)
+                scans = np.array(a_data).reshape(-1, len(self.mps))
+                scans[scans == DUMMY_VALUE] = np.nan
+                self._store(scans * self.scales + self.offsets)
+                if time.time() >= next_summary:
+                    self._post_summary(summary_start, self.scan_count)
+                    summary_start = self.scan_count
+                    next_summary += SUMMARY_INTERVAL
+        except ljm.LJMError as e:
+            self.log_msg_q.put((log.ERROR, MODULE, "{}: Stream read failed. LJMError: {}".format(self.source, e)))
+        finally:
+            try:
+                ljm.eStreamStop(self.lj_handle)
+            except ljm.LJMError:
+                pass
+        self.log_msg_q.put((log.INFO, MODULE, "{}: Stream stopped".format(self.source)))
+
+    def _store(self, scans):
+        n = len(self.buffer)
+        with self._lock:
+            start = self.scan_count % n
+            end = start + len(scans)
+            if end <= n:
+                self.buffer[start: end] = scans
+            else:
+                split = n - start
+                self.buffer[start:] = scans[: split]
+                self.buffer[: end - n] = scans[split:]
+            self.scan_count += len(scans)
+
+    def _get_range(self, first, last):
+        # Returns MJD times and a copy of the data for scans first to last - 1, limited to what is still buffered
+        n = len(self.buffer)
+        with self._lock:
+            first = max(first, self.scan_count - n, 0)
+            last = min(last, self.scan_count)
+            index = np.arange(first, last)
+            data = self.buffer[index % n]
+        times = self.mjd_start + index / self.scan_rate / SECONDS_PER_DAY
+        return times, data
+
+    def _post_summary(self, first, last):
+        times, data = self._get_range(first, last)
+        if len(data) == 0:
+            return
+        summary = []
+        for i in range(len(self.mps)):
+            # A channel with no valid scans in the interval, e.g. all skipped by the device, is summarised as NaN
+            column = data[:, i]
+            column = column[~np.isnan(column)]
+            if len(column) == 0:
+                summary += [np.nan] * 3
+            else:
+                summary += [float(column.min()), float(column.max()), float(column.mean())]
+        ts = hwmc_time.mjd()
+        self.mp_q.post((ts, self.source, MpRecord(self.summary_schema, summary)))
+
+    def get_recent(self, seconds):
+        # Full-rate data for the last 'seconds' of the stream, as (MJD times, scans x channels array)
+        count = self.scan_count
+        return self._get_range(count - int(seconds * self.scan_rate), count)
+
+    def dump(self, seconds, file_name):
+        times, data = self.get_recent(seconds)
+        np.savez(file_name, mjd=times, data=data, mps=np.array(self.mps))
+        return len(times)
@@ -1,13 +1,111 @@
-import select
-import socket
+import asyncio
+import fnmatch
+import math
 import hwmc_logging as log
-import queue
+import hwmc_stats as stats
+import mp_index
+import mp_protocol as proto
+from mp_compress import SUFFIX
+import hwmc_time
+import time
 import os
 
 MODULE = os.path.basename(__file__)
 SERVER_IP = 'localhost'
 SERVER_PORT = 50000
 BLOCK_SIZE = 1024
+MAX_DRAIN = 4096            # Maximum number of monitor packets fanned out in one cycle
+CLIENT_BUFFER_LIMIT = 1 << 20   # Unsent bytes allowed per client before it is considered too slow and dropped
+SECONDS_PER_DAY = 86400
+WILDCARDS = '*?['
+DECIMATIONS = ('every', 'min', 'max', 'mean')
+GET_REQUEST = 'get '        # Prefix of a one-shot request for current values
+GET_END = b'end\n'          # Line sent after the reply to a one-shot request
+HISTORY_REQUEST = 'history '    # Prefix of a request for stored data, see _start_history
+
+# Time taken to fan out each batch of packets, published by hwmc_stats. The unsent bytes of each client after each
+# send are published as client<N>_backlog, where N is the lowest number not used by another connected client.
+SEND_TIME = stats.histogram('server_send')
+BACKLOG_NAME = 'client{}_backlog'
+
+
+class MpClient:
+    '''Connection state for one monitor point client'''
+    def __init__(self, writer, number):
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.number = number
+        self.backlog = stats.histogram(BACKLOG_NAME.format(number), 1.0, 1e8)
+        self.in_buf = ''
+        self.out_buf = bytearray()
+        self.keys = set()
+        # Binary protocol state: the number of source and point IDs already sent to the client, and the packet
+        # blocks waiting to be framed at the end of a dispatch cycle
+        self.binary = False
+        self.sources_sent = 0
+        self.points_sent = 0
+        self.blocks = []
+
+
+class Subscription:
+    '''One subscription line from a client, with the state needed to decimate what it matches'''
+    def __init__(self, client, source, mp, mode=None, param=1):
+        '''Create a subscription
+
+        Arguments
+        client -- the subscribing MpClient
+        source, mp -- source and monitor point names, which may contain shell-style wildcards
+        mode -- None to send every sample, 'every' to send every param'th sample, or 'min', 'max' or 'mean' to
+                send one aggregate per window of param seconds
+        param -- decimation factor or window length
+        '''
+        self.client = client
+        self.source = source
+        self.mp = mp
+        self.mode = mode
+        self.param = param
+        self.state = {}
+        # Live samples waiting while stored data is replayed, or None once the subscription is live
+        self.held = None
+
+    def is_pattern(self):
+        return any(c in WILDCARDS for c in self.source + self.mp)
+
+    def matches(self, key):
+        return fnmatch.fnmatchcase(key[0], self.source) and fnmatch.fnmatchcase(key[1], self.mp)
+
+    def offer(self, key, timestamp, val):
+        # Returns the (timestamp, value) to send for a new sample, or None if nothing is due
+        if self.mode is None:
+            return timestamp, val
+        if self.mode == 'every':
+            count = self.state.get(key, 0)
+            self.state[key] = count + 1
+            return (timestamp, val) if count % self.param == 0 else None
+        # Window aggregates are sent when the first sample of the next window arrives
+        window = int(timestamp * SECONDS_PER_DAY // self.param)
+        val = float(val)
+        state = self.state.get(key)
+        result = None
+        if state is not None and state[0] != window:
+            result = (state[1], self._aggregate(state))
+            state = None
+        if state is None:
+            self.state[key] = [window, timestamp, val, val, val, 1]
+        else:
+            state[1] = timestamp
+            state[2] = min(state[2], val)
+            state[3] = max(state[3], val)
+            state[4] += val
+            state[5] += 1
+        return result
+
+    def _aggregate(self, state):
+        if self.mode == 'min':
+            return state[2]
+        if self.mode == 'max':
+            return state[3]
+        return state[4] / state[5]
 
 
 class MpServer:
@@ -15,64 +113,394 @@ class MpServer:
         self.monitor_q = monitor_q
         self.log_msg_q = log_msg_q
         log_msg_q.put((log.INFO, MODULE, "Initializing monitor server"))
-        self.stop = False
+        self.server = None
+        self.loop = None
+        self._pump_task = None
+        self._data_ready = None
+        self._wake_pending = False
+        self.clients = set()
+        # Index from (source, monitor point) to the subscription of each client that wants it. Wildcard
+        # subscriptions are resolved into the index the first time a matching point is seen.
+        self.subscribers = {}
+        self.patterns = []
+        self.known_keys = set()
+        # Latest (timestamp, value) of every (source, monitor point), sent to new subscribers straight away
+        self.latest = {}
+        # Integer IDs of source and point names for binary clients, in the order the names were first seen
+        self.source_ids = {}
+        self.source_names = []
+        self.point_ids = {}
+        self.point_names = []
 
-    def run_server(self):
+    async def start(self):
+        # Runs on the ServerLoop. The monitor queue's writer thread wakes the loop when it has new packets.
         self.log_msg_q.put((log.INFO, MODULE, "Starting monitor server"))
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setblocking(False)
-        server.bind((SERVER_IP, SERVER_PORT))
-        server.listen(5)
-        inputs = [server]
-        outputs = []
-        message_queues = {}
-        mp_filter = {}
-
-        while inputs:
-            if self.stop:
-                self.log_msg_q.put((log.INFO, MODULE, "Stopping monitor server"))
-                break
-            mon_data = []
-            if not self.monitor_q.empty():
-                mon_data = self.monitor_q.get()
-            readable, writable, exceptional = select.select(inputs, outputs, inputs, 1)
-            for s in readable:
-                if s is server:
-                    connection, client_address = s.accept()
-                    connection.setblocking(False)
-                    inputs.append(connection)
-                    message_queues[connection] = queue.Queue()
+        self.loop = asyncio.get_running_loop()
+        self._data_ready = asyncio.Event()
+        self.server = await asyncio.start_server(self._serve_client, SERVER_IP, SERVER_PORT)
+        self._pump_task = self.loop.create_task(self._pump())
+        self.monitor_q.notify = self._notify
+        stats.gauge('clients', lambda: len(self.clients))
+        self._data_ready.set()
+
+    async def close(self):
+        self.log_msg_q.put((log.INFO, MODULE, "Stopping monitor server"))
+        self.monitor_q.notify = None
+        self.server.close()
+        self._pump_task.cancel()
+        for client in list(self.clients):
+            self._remove_client(client, "server stopping")
+        await self.server.wait_closed()
+
+    def _notify(self):
+        # Called from the monitor queue's writer thread; a wake-up already on its way covers this one too
+        if not self._wake_pending:
+            self._wake_pending = True
+            try:
+                self.loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                pass
+
+    def _wake(self):
+        self._wake_pending = False
+        self._data_ready.set()
+
+    async def _pump(self):
+        while True:
+            await self._data_ready.wait()
+            self._data_ready.clear()
+            packets = self.monitor_q.get_all(MAX_DRAIN)
+            while packets:
+                t_start = time.perf_counter()
+                self.dispatch(packets)
+                for client in list(self.clients):
+                    self._send_client(client)
+                SEND_TIME.record(time.perf_counter() - t_start)
+                if len(packets) < MAX_DRAIN:
+                    break
+                # Let client connections be served between large batches
+                await asyncio.sleep(0)
+                packets = self.monitor_q.get_all(MAX_DRAIN)
+
+    async def _serve_client(self, reader, writer):
+        numbers = {c.number for c in self.clients}
+        client = MpClient(writer, min(n for n in range(1, len(numbers) + 2) if n not in numbers))
+        self.clients.add(client)
+        self.log_msg_q.put((log.INFO, MODULE, "Monitor client {} connected, backlog published as {}"
+                            .format(client.address, BACKLOG_NAME.format(client.number))))
+        reason = "connection closed"
+        try:
+            while True:
+                data = await reader.read(BLOCK_SIZE)
+                if not data:
+                    break
+                self._read_client(client, data)
+                self._send_client(client)
+        except (ConnectionResetError, ConnectionAbortedError):
+            reason = "connection reset"
+        finally:
+            self._remove_client(client, reason)
+
+    def subscribe(self, sub):
+        if sub.is_pattern():
+            self.patterns.append(sub)
+            for key in self.known_keys | set(self.subscribers):
+                if sub.matches(key):
+                    self._add_to_index(key, sub)
+        else:
+            self._add_to_index((sub.source, sub.mp), sub)
+
+    def _add_to_index(self, key, sub):
+        # A later subscription from the same client replaces an earlier one for the same point
+        subs = self.subscribers.get(key)
+        if subs is None:
+            subs = self.subscribers[key] = {}
+            if key not in self.known_keys:
+                # Patterns are resolved when a point is first seen, which finds the entry made here, so the
+                # patterns it matches are added now
+                for pattern in self.patterns:
+                    if pattern.matches(key):
+                        subs[pattern.client] = pattern
+                        pattern.client.keys.add(key)
+        subs[sub.client] = sub
+        sub.client.keys.add(key)
+
+    def _resolve(self, key):
+        self.known_keys.add(key)
+        for sub in self.patterns:
+            if sub.matches(key):
+                self._add_to_index(key, sub)
+        return self.subscribers.get(key)
+
+    def _get_id(self, ids, names, name):
+        i = ids.get(name)
+        if i is None:
+            i = len(names)
+            ids[name] = i
+            names.append(name)
+        return i
+
+    def _send_schema(self, client):
+        # Send the names given IDs since the client was last told, so they are defined before they are used
+        if client.sources_sent < len(self.source_names) or client.points_sent < len(self.point_names):
+            client.out_buf += proto.encode_schema(client.sources_sent, self.source_names[client.sources_sent:],
+                                                  client.points_sent, self.point_names[client.points_sent:])
+            client.sources_sent = len(self.source_names)
+            client.points_sent = len(self.point_names)
+
+    def _add_block(self, client, timestamp, source, points):
+        # Points is a list of (point name, value) from one source with one timestamp
+        source_id = self._get_id(self.source_ids, self.source_names, source)
+        point_ids = [self._get_id(self.point_ids, self.point_names, mp) for mp, _ in points]
+        self._send_schema(client)
+        values = [proto.to_float(v) for _, v in points]
+        client.blocks.append(proto.encode_block(timestamp, source_id, point_ids, values))
+
+    def _flush_blocks(self, client, frame_type, prefix=b''):
+        client.out_buf += proto.encode_frame(frame_type, prefix + b''.join(client.blocks))
+        client.blocks = []
+
+    def dispatch(self, packets):
+        # Queue each monitor point of each packet for the clients subscribed to it. Binary clients are sent one
+        # frame per cycle holding a block of points for each packet.
+        subscribers = self.subscribers
+        known_keys = self.known_keys
+        latest = self.latest
+        binary_clients = set()
+        for timestamp, source, mp_packet in packets:
+            binary_points = {}
+            for mp, val in mp_packet.items():
+                key = (source, mp)
+                latest[key] = (timestamp, val)
+                subs = subscribers.get(key)
+                if subs is None:
+                    if key in known_keys:
+                        continue
+                    subs = self._resolve(key)
+                    if not subs:
+                        continue
+                line = None
+                for client, sub in subs.items():
+                    if sub.held is not None:
+                        sub.held.append((timestamp, source, mp, val))
+                    elif client.binary:
+                        result = sub.offer(key, timestamp, val)
+                        if result is not None:
+                            binary_points.setdefault((client, result[0]), []).append((mp, result[1]))
+                    elif sub.mode is None:
+                        if line is None:
+                            line = "{},{},{},{}\n".format(timestamp, source, mp, val).encode('ascii')
+                        client.out_buf += line
+                    else:
+                        result = sub.offer(key, timestamp, val)
+                        if result is not None:
+                            client.out_buf += "{},{},{},{}\n".format(result[0], source, mp, result[1]).encode('ascii')
+            for (client, block_time), points in binary_points.items():
+                self._add_block(client, block_time, source, points)
+                binary_clients.add(client)
+        for client in binary_clients:
+            self._flush_blocks(client, proto.FRAME_DATA)
+
+    def _send_packets(self, sub, packets, replayed=None):
+        # Send the points of the packets that match a single subscription, skipping samples no newer than the last
+        # replayed sample of the same point
+        client = sub.client
+        for timestamp, source, mp_packet in packets:
+            binary_points = {}
+            lines = []
+            for mp, val in mp_packet.items():
+                key = (source, mp)
+                if not sub.matches(key):
+                    continue
+                if replayed is not None:
+                    if timestamp <= replayed.get(key, 0.0):
+                        continue
+                    replayed[key] = timestamp
+                result = sub.offer(key, timestamp, val)
+                if result is None:
+                    continue
+                if client.binary:
+                    binary_points.setdefault(result[0], []).append((mp, result[1]))
                 else:
-                    try:
-                        data = s.recv(BLOCK_SIZE)
-                        data = data.decode('ascii').lower()
-                        data_lines = data.splitlines()
-                        for line in data_lines:
-                            source, mp = line.split(',')
-                            filt = (source, mp)
-                            if s not in mp_filter:
-                                mp_filter[s] = [filt]
-                            elif filt not in mp_filter[s]:
-                                mp_filter[s].append(filt)
-                        if data:
-                            if s not in outputs:
-                                outputs.append(s)
-                    except (ConnectionResetError, ConnectionAbortedError):
-                        inputs.remove(s)
-                        outputs.remove(s)
-
-            for s in writable:
-                if mon_data:
-                    filt = mp_filter[s]
-                    mjd, mp_source, mp_name, val = str(mon_data).split(',')
-                    for f in filt:
-                        source, mp = f
-                        if source == mp_source.lower() and mp == mp_name.lower():
-                            s.send(mon_data)
-
-            for s in exceptional:
-                inputs.remove(s)
-                if s in outputs:
-                    outputs.remove(s)
-                s.close()
-                del message_queues[s]
+                    lines.append("{},{},{},{}\n".format(result[0], source, mp, result[1]))
+            for block_time, points in binary_points.items():
+                self._add_block(client, block_time, source, points)
+            if lines:
+                client.out_buf += ''.join(lines).encode('ascii')
+        if client.blocks:
+            self._flush_blocks(client, proto.FRAME_DATA)
+
+    def _start_history(self, sub, time_range):
+        '''Replay stored data for a subscription
+
+        time_range is either a number of seconds, to replay that much history and then continue with live data, or
+        start:end in MJD, to replay only that range and end the reply like a one-shot request.
+        '''
+        now = hwmc_time.mjd()
+        start, sep, end = time_range.partition(':')
+        try:
+            if sep:
+                t_start, t_end = float(start), float(end)
+            else:
+                t_start, t_end = now - float(start) / SECONDS_PER_DAY, now
+        except ValueError:
+            return False
+        live = not sep
+        if live:
+            # Live data is held back while the history is read, then sent after it
+            sub.held = []
+            self.subscribe(sub)
+        self.loop.create_task(self._replay(sub, t_start, t_end, live))
+        return True
+
+    def _history_files(self, t_start, t_end):
+        # One monitor point file per UT day, read through its index, possibly after it has been compressed
+        for day in range(int(t_start), int(t_end) + 1):
+            date = hwmc_time.date(day)
+            file_name = self.monitor_q.file_prefix + date + '.mp'
+            if ((os.path.exists(file_name) or os.path.exists(file_name + SUFFIX)) and
+                    os.path.exists(mp_index.index_name(file_name))):
+                yield file_name
+
+    async def _replay(self, sub, t_start, t_end, live):
+        # Stream the history a chunk at a time, reading the files on a worker thread and waiting for each chunk to
+        # be taken by the client before reading the next
+        client = sub.client
+        replayed = {}
+        try:
+            for file_name in self._history_files(t_start, t_end):
+                chunks = mp_index.iter_range(file_name, sub.source, t_start, t_end)
+                while True:
+                    packets = await self.loop.run_in_executor(None, next, chunks, None)
+                    if packets is None or client not in self.clients:
+                        break
+                    self._send_packets(sub, packets, replayed)
+                    self._send_client(client)
+                    await client.writer.drain()
+        except (OSError, ValueError) as e:
+            self.log_msg_q.put((log.WARN, MODULE, "History for {} stopped: {}".format(client.address, e)))
+        if client not in self.clients:
+            return
+        if live:
+            packets = []
+            for timestamp, source, mp, val in sub.held:
+                if not packets or packets[-1][: 2] != (timestamp, source):
+                    packets.append((timestamp, source, {}))
+                packets[-1][2][mp] = val
+            sub.held = None
+            self._send_packets(sub, packets, replayed)
+        else:
+            client.out_buf += proto.encode_frame(proto.FRAME_END, b'') if client.binary else GET_END
+        self._send_client(client)
+
+    def send_snapshot(self, sub):
+        # Send the latest value of every point matching a subscription, with the age of each value in seconds as an
+        # extra field
+        client = sub.client
+        if sub.is_pattern():
+            keys = sorted(key for key in self.latest if sub.matches(key))
+        else:
+            keys = [(sub.source, sub.mp)] if (sub.source, sub.mp) in self.latest else []
+        if not keys:
+            return
+        now = hwmc_time.mjd()
+        if client.binary:
+            blocks = {}
+            for key in keys:
+                timestamp, val = self.latest[key]
+                blocks.setdefault((key[0], timestamp), []).append((key[1], val))
+            for (source, timestamp), points in blocks.items():
+                self._add_block(client, timestamp, source, points)
+            self._flush_blocks(client, proto.FRAME_SNAPSHOT, proto.MJD.pack(now))
+            return
+        lines = []
+        for key in keys:
+            timestamp, val = self.latest[key]
+            age = (now - timestamp) * SECONDS_PER_DAY
+            lines.append("{},{},{},{},{:.3f}\n".format(timestamp, key[0], key[1], val, age))
+        client.out_buf += ''.join(lines).encode('ascii')
+
+    def _parse_subscription(self, client, line):
+        # Subscription lines are source,point[,every=N|min=S|max=S|mean=S], with optional wildcards in the names
+        fields = [f.strip() for f in line.split(',')]
+        if len(fields) not in (2, 3) or not fields[0] or not fields[1]:
+            return None
+        mode, param = None, 1
+        if len(fields) == 3:
+            mode, _, value = fields[2].partition('=')
+            if mode not in DECIMATIONS:
+                return None
+            try:
+                # A decimation factor is a whole number of samples, a window any number of seconds
+                param = int(value) if mode == 'every' else float(value)
+            except ValueError:
+                return None
+            if param <= 0 or not math.isfinite(param):
+                return None
+        return Subscription(client, fields[0], fields[1], mode, param)
+
+    def _read_client(self, client, data):
+        # Only complete lines are processed; a partial line waits for the rest to arrive. Bytes that are not ASCII
+        # are replaced, leaving a line that matches nothing or is rejected as invalid.
+        client.in_buf += data.decode('ascii', 'replace').lower()
+        *lines, client.in_buf = client.in_buf.split('\n')
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line == proto.PROTOCOL_REQUEST:
+                # Everything sent from now on is binary frames, starting with the IDs known so far
+                client.binary = True
+                client.out_buf += proto.encode_schema(0, self.source_names, 0, self.point_names)
+                client.sources_sent = len(self.source_names)
+                client.points_sent = len(self.point_names)
+                continue
+            if line.startswith(HISTORY_REQUEST):
+                time_range, _, line = line[len(HISTORY_REQUEST):].strip().partition(' ')
+                sub = self._parse_subscription(client, line)
+                if sub is None or not self._start_history(sub, time_range):
+                    self.log_msg_q.put((log.WARN, MODULE, "Invalid history request from {}: {}"
+                                        .format(client.address, line)))
+                continue
+            one_shot = line.startswith(GET_REQUEST)
+            if one_shot:
+                line = line[len(GET_REQUEST):]
+            sub = self._parse_subscription(client, line)
+            if sub is None:
+                self.log_msg_q.put((log.WARN, MODULE, "Invalid subscription from {}: {}".format(client.address, line)))
+                continue
+            self.send_snapshot(sub)
+            if one_shot:
+                client.out_buf += proto.encode_frame(proto.FRAME_END, b'') if client.binary else GET_END
+            else:
+                self.subscribe(sub)
+
+    def _send_client(self, client):
+        # The transport buffers whatever the socket cannot take straight away
+        if not client.out_buf or client not in self.clients:
+            return
+        transport = client.writer.transport
+        if transport.is_closing():
+            self._remove_client(client, "send failed")
+            return
+        transport.write(bytes(client.out_buf))
+        client.out_buf.clear()
+        backlog = transport.get_write_buffer_size()
+        client.backlog.record(backlog)
+        if backlog > CLIENT_BUFFER_LIMIT:
+            transport.abort()
+            self._remove_client(client, "client too slow")
+
+    def _remove_client(self, client, reason):
+        if client not in self.clients:
+            return
+        self.log_msg_q.put((log.INFO, MODULE, "Dropping monitor client {}: {}".format(client.address, reason)))
+        self.clients.remove(client)
+        stats.remove(BACKLOG_NAME.format(client.number))
+        for key in client.keys:
+            subs = self.subscribers[key]
+            del subs[client]
+            if not subs:
+                del self.subscribers[key]
+        self.patterns = [sub for sub in self.patterns if sub.client is not client]
+        client.writer.close()
@@ -0,0 +1,177 @@
+import argparse
+import bisect
+import collections
+import glob
+import io
+import os
+import struct
+import subprocess
+import sys
+import zlib
+import hwmc_logging as log
+
+MODULE = os.path.basename(__file__)
+
+SUFFIX = '.zb'          # A compressed copy of 'name.mp' is 'name.mp.zb'
+MAGIC = b'DSAZB1\n'
+BLOCK_SIZE = 1 << 20    # Uncompressed bytes per independently compressed block
+COMPRESS_LEVEL = 6
+NICENESS = 10           # Compression runs at lower priority than acquisition
+
+# Each block table entry is (uncompressed offset, compressed offset, compressed length). The footer at the end of
+# the file locates the table and gives the uncompressed size.
+BLOCK_ENTRY = struct.Struct('<QQI')
+FOOTER = struct.Struct('<QQQ{}s'.format(len(MAGIC)))
+
+
+def compress_file(file_name, level=COMPRESS_LEVEL):
+    '''Compress a closed file into the seekable block format and remove the original
+
+    The file is compressed in independent blocks of BLOCK_SIZE bytes followed by a table of block offsets, so a
+    reader can seek to any uncompressed offset by decompressing a single block.
+    '''
+    out_name = file_name + SUFFIX
+    tmp_name = out_name + '.tmp'
+    blocks = []
+    size = 0
+    with open(file_name, 'rb') as f_in, open(tmp_name, 'wb') as f_out:
+        f_out.write(MAGIC)
+        block = f_in.read(BLOCK_SIZE)
+        while block:
+            compressed = zlib.compress(block, level)
+            blocks.append(BLOCK_ENTRY.pack(size, f_out.tell(), len(compressed)))
+            f_out.write(compressed)
+            size += len(block)
+            block = f_in.read(BLOCK_SIZE)
+        table_offset = f_out.tell()
+        f_out.write(b''.join(blocks))
+        f_out.write(FOOTER.pack(table_offset, len(blocks), size, MAGIC))
+        f_out.flush()
+        os.fsync(f_out.fileno())
+    os.replace(tmp_name, out_name)
+    os.remove(file_name)
+    return out_name
+
+
+class BlockReader(io.RawIOBase):
+    '''Seekable raw reader for block-compressed files, decompressing one block at a time'''
+    def __init__(self, file_name):
+        super().__init__()
+        self.f = open(file_name, 'rb')
+        self.f.seek(-FOOTER.size, os.SEEK_END)
+        table_offset, num_blocks, self.size, magic = FOOTER.unpack(self.f.read(FOOTER.size))
+        if magic != MAGIC:
+            self.f.close()
+            raise ValueError("'{}' is not a block compressed file".format(file_name))
+        self.f.seek(table_offset)
+        table = self.f.read(num_blocks * BLOCK_ENTRY.size)
+        self.blocks = [BLOCK_ENTRY.unpack_from(table, i * BLOCK_ENTRY.size) for i in range(num_blocks)]
+        self.starts = [b[0] for b in self.blocks]
+        self.pos = 0
+        self._cached = (-1, b'')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def _block(self, i):
+        if self._cached[0] != i:
+            start, offset, length = self.blocks[i]
+            self.f.seek(offset)
+            self._cached = (i, zlib.decompress(self.f.read(length)))
+        return self._cached[1]
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        i = bisect.bisect_right(self.starts, self.pos) - 1
+        data = self._block(i)
+        start = self.pos - self.starts[i]
+        n = min(len(b), len(data) - start)
+        b[: n] = data[start: start + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def open_archived(file_name):
+    # Open a file for binary reading, transparently reading its compressed copy if it has been compressed
+    if os.path.exists(file_name) or not os.path.exists(file_name + SUFFIX):
+        return open(file_name, 'rb')
+    return io.BufferedReader(BlockReader(file_name + SUFFIX))
+
+
+class Compressor:
+    '''Compresses closed files one at a time in a separate, low-priority process'''
+    def __init__(self, log_msg_q):
+        self.log_msg_q = log_msg_q
+        self.pending = collections.deque()
+        self.job = None
+
+    def submit(self, file_name):
+        self.pending.append(file_name)
+        self.poll()
+
+    def submit_old(self, pattern, current_file_name):
+        # Queue files left uncompressed by an earlier run, other than the one currently being written
+        for file_name in sorted(glob.glob(pattern)):
+            if file_name != current_file_name:
+                self.submit(file_name)
+
+    def poll(self):
+        # Cheap enough to call from the writing threads' loops; never waits for the compression process
+        if self.job is not None:
+            file_name, proc = self.job
+            if proc.poll() is None:
+                return
+            if proc.returncode == 0:
+                self.log_msg_q.put((log.INFO, MODULE, "Compressed '{}'".format(file_name)))
+            else:
+                self.log_msg_q.put((log.ERROR, MODULE, "Compressing '{}' failed with status {}"
+                                    .format(file_name, proc.returncode)))
+            self.job = None
+        if self.pending:
+            file_name = self.pending.popleft()
+            try:
+                proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), file_name],
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+                self.job = (file_name, proc)
+            except OSError as e:
+                self.log_msg_q.put((log.ERROR, MODULE, "Unable to start compressing '{}': {}".format(file_name, e)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Block-compress closed monitor point and log files, or read them")
+    parser.add_argument('files', nargs='+', help="files to compress, or to read with --cat")
+    parser.add_argument('--cat', action='store_true', help="write the uncompressed contents to stdout")
+    args = parser.parse_args()
+    if args.cat:
+        for file_name in args.files:
+            with open_archived(file_name) as f:
+                for line in f:
+                    sys.stdout.buffer.write(line)
+        return
+    if hasattr(os, 'nice'):
+        os.nice(NICENESS)
+    for file_name in args.files:
+        compress_file(file_name)
+
+
+if __name__ == '__main__':
+    main()
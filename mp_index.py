@@ -0,0 +1,218 @@
+import argparse
+import fnmatch
+import os
+import numpy as np
+from mp_store import HEADER_SIZE, read_header, write_header
+from mp_compress import open_archived
+
+MAGIC = b'DSAMPX1\n'
+INDEX_SUFFIX = 'x'      # The index of 'name.mp' is 'name.mpx'
+FORMAT_VERSION = 1
+BLOCK_ENTRIES = 4096    # Entries per time block used to narrow a search
+TIME_SLACK = 60.0 / 86400  # Allowed disorder of entry times in days, e.g. from packets coalesced under load
+CHUNK_BYTES = 1 << 18   # Bytes of the .mp file read at a time when streaming a time range
+
+# One entry per packet: the sample time, the source ID, and the byte range of the packet's lines in the .mp file
+ENTRY_DTYPE = np.dtype([('mjd', '<f8'), ('source', '<u4'), ('length', '<u4'), ('offset', '<u8')])
+
+
+def index_name(mp_file_name):
+    return mp_file_name + INDEX_SUFFIX
+
+
+class MpIndex:
+    '''Sidecar index of a text monitor point file, written as the file is produced'''
+    def __init__(self, file_name):
+        '''Open an index for appending, creating it if necessary
+
+        Arguments
+        file_name -- name of the index file, normally index_name() of the .mp file
+        '''
+        self.file_name = file_name
+        if os.path.exists(file_name) and os.path.getsize(file_name) >= HEADER_SIZE:
+            self.f = open(file_name, 'r+b')
+            self.header = read_header(self.f, MAGIC)
+            # Drop any partial entry left by an earlier crash
+            num_entries = (os.path.getsize(file_name) - HEADER_SIZE) // ENTRY_DTYPE.itemsize
+            self.f.truncate(HEADER_SIZE + num_entries * ENTRY_DTYPE.itemsize)
+        else:
+            self.f = open(file_name, 'w+b')
+            self.header = {'version': FORMAT_VERSION, 'sources': []}
+            write_header(self.f, self.header, MAGIC)
+        self.f.seek(0, os.SEEK_END)
+        self.source_ids = {source: i for i, source in enumerate(self.header['sources'])}
+
+    def _get_source_id(self, source):
+        source_id = self.source_ids.get(source)
+        if source_id is None:
+            source_id = len(self.header['sources'])
+            self.header['sources'].append(source)
+            self.source_ids[source] = source_id
+            write_header(self.f, self.header, MAGIC)
+        return source_id
+
+    def add(self, entries):
+        # entries is a list of (mjd, source, offset, length) for packets written to the .mp file
+        index = np.zeros(len(entries), dtype=ENTRY_DTYPE)
+        for row, (mjd, source, offset, length) in enumerate(entries):
+            index[row] = (mjd, self._get_source_id(source), length, offset)
+        self.f.write(index.tobytes())
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def read_index(file_name):
+    # Returns the index header and a read-only numpy.memmap of its entries
+    with open(file_name, 'rb') as f:
+        header = read_header(f, MAGIC)
+    num_entries = (os.path.getsize(file_name) - HEADER_SIZE) // ENTRY_DTYPE.itemsize
+    if num_entries <= 0:
+        return header, np.zeros(0, dtype=ENTRY_DTYPE)
+    return header, np.memmap(file_name, dtype=ENTRY_DTYPE, mode='r', offset=HEADER_SIZE, shape=(num_entries,))
+
+
+def build_index(mp_file_name):
+    '''Index an existing .mp file, e.g. one written before indexing was enabled
+
+    Consecutive lines with the same timestamp and source are treated as one packet.
+    '''
+    index = MpIndex(index_name(mp_file_name))
+    index.f.truncate(HEADER_SIZE)
+    entries = []
+    with open_archived(mp_file_name) as f:
+        offset = 0
+        key = None
+        start = 0
+        for line in f:
+            fields = line.split(b',', 2)
+            if len(fields) == 3 and (fields[0], fields[1]) != key:
+                if key is not None:
+                    entries.append((float(key[0]), key[1].decode('ascii'), start, offset - start))
+                key = (fields[0], fields[1])
+                start = offset
+            offset += len(line)
+        if key is not None:
+            entries.append((float(key[0]), key[1].decode('ascii'), start, offset - start))
+    index.add(entries)
+    index.close()
+    return len(entries)
+
+
+def _find_entries(header, entries, source, t_start, t_end):
+    # Entries are in the order packets were written, which is time order to within TIME_SLACK. Use the first time
+    # of each block of entries to find the blocks that can hold the time range, then search only those.
+    if source not in header['sources'] or len(entries) == 0:
+        return entries[:0]
+    block_times = np.asarray(entries['mjd'][::BLOCK_ENTRIES])
+    first = max(int(np.searchsorted(block_times, t_start - TIME_SLACK)) - 1, 0) * BLOCK_ENTRIES
+    last = int(np.searchsorted(block_times, t_end + TIME_SLACK)) * BLOCK_ENTRIES
+    candidates = entries[first: last]
+    mask = ((candidates['source'] == header['sources'].index(source)) & (candidates['mjd'] >= t_start) &
+            (candidates['mjd'] < t_end))
+    return candidates[mask]
+
+
+def _read_runs(f, found, max_bytes=None):
+    # Read each run of adjacent packets in found, which is sorted by offset, with a single seek and read, stopping a
+    # run once it holds max_bytes. Yields the number of bytes and the lines of each run.
+    i = 0
+    while i < len(found):
+        start = int(found['offset'][i])
+        end = start + int(found['length'][i])
+        i += 1
+        while i < len(found) and int(found['offset'][i]) == end and (max_bytes is None or end - start < max_bytes):
+            end += int(found['length'][i])
+            i += 1
+        f.seek(start)
+        yield end - start, f.read(end - start).decode('ascii').splitlines()
+
+
+def query(mp_file_name, pairs, t_start, t_end):
+    '''Read a time range of chosen monitor points from a .mp file, using its index
+    The file may have been block compressed by mp_compress.
+
+    Arguments
+    mp_file_name -- name of the .mp file
+    pairs -- list of (source, monitor point) tuples
+    t_start, t_end -- MJD range, t_start <= mjd < t_end
+
+    Returns a dictionary of (source, monitor point) to a list of (mjd, value string) in time order
+    '''
+    header, entries = read_index(index_name(mp_file_name))
+    wanted = {}
+    for source, mp in pairs:
+        wanted.setdefault(source, set()).add(mp)
+    result = {pair: [] for pair in pairs}
+    with open_archived(mp_file_name) as f:
+        for source, mps in wanted.items():
+            found = np.sort(_find_entries(header, entries, source, t_start, t_end), order='offset')
+            for _, lines in _read_runs(f, found):
+                for line in lines:
+                    mjd, mp_source, mp, val = line.split(',')
+                    if mp in mps and mp_source == source:
+                        result[(source, mp)].append((float(mjd), val))
+    for points in result.values():
+        points.sort()
+    return result
+
+
+def iter_range(mp_file_name, source_pattern, t_start, t_end, chunk_bytes=CHUNK_BYTES):
+    '''Read a time range of all the points from matching sources in a .mp file, a piece at a time
+
+    Arguments
+    mp_file_name -- name of the .mp file, which may have been block compressed by mp_compress
+    source_pattern -- shell-style pattern of the source names to read
+    t_start, t_end -- MJD range, t_start <= mjd < t_end
+
+    Yields lists of (mjd, source, {monitor point: value string}) packets in the order they were written, reading
+    about chunk_bytes of the file for each list.
+    '''
+    header, entries = read_index(index_name(mp_file_name))
+    found = [_find_entries(header, entries, source, t_start, t_end)
+             for source in header['sources'] if fnmatch.fnmatchcase(source, source_pattern)]
+    if not found:
+        return
+    found = np.sort(np.concatenate(found), order='offset')
+    with open_archived(mp_file_name) as f:
+        packets = []
+        num_bytes = 0
+        for run_bytes, lines in _read_runs(f, found, chunk_bytes):
+            key = None
+            for line in lines:
+                mjd, source, mp, val = line.split(',')
+                if (mjd, source) != key:
+                    key = (mjd, source)
+                    packet = {}
+                    packets.append((float(mjd), source, packet))
+                packet[mp] = val
+            num_bytes += run_bytes
+            if num_bytes >= chunk_bytes:
+                yield packets
+                packets = []
+                num_bytes = 0
+        if packets:
+            yield packets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read monitor points for a time range from an indexed .mp file")
+    parser.add_argument('mp_file', help="monitor point file, e.g. dsa-110-test-2020-01-01.mp")
+    parser.add_argument('points', nargs='+', help="source,point pairs, e.g. ant12,foc_temp")
+    parser.add_argument('--start', type=float, default=0.0, help="start MJD")
+    parser.add_argument('--end', type=float, default=1e6, help="end MJD")
+    parser.add_argument('--build', action='store_true', help="(re)build the index from the .mp file first")
+    args = parser.parse_args()
+    if args.build:
+        print("Indexed {} packets".format(build_index(args.mp_file)))
+    pairs = [tuple(p.lower().split(',')) for p in args.points]
+    for (source, mp), points in query(args.mp_file, pairs, args.start, args.end).items():
+        for mjd, val in points:
+            print("{},{},{},{}".format(mjd, source, mp, val))
+
+
+if __name__ == '__main__':
+    main()
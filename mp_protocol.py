@@ -0,0 +1,95 @@
+import json
+import struct
+
+# A client switches its connection to the binary protocol by sending this line to the monitor server
+PROTOCOL_REQUEST = 'binary'
+
+# Every frame starts with its payload length and type
+FRAME_HEADER = struct.Struct('<IB')
+FRAME_SCHEMA = 1    # JSON: new source and monitor point names and the integer IDs they have been given
+FRAME_DATA = 2      # Packet blocks for live data
+FRAME_SNAPSHOT = 3  # Server MJD (f8), then packet blocks holding the latest values
+FRAME_END = 4       # Empty; ends the reply to a one-shot request
+
+# A packet block is the MJD, source ID and number of points, then the point IDs (u16) and values (f8)
+BLOCK_HEADER = struct.Struct('<dHH')
+MJD = struct.Struct('<d')
+SECONDS_PER_DAY = 86400
+
+
+def to_float(val):
+    # Values that are not numbers are sent as NaN
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+def encode_frame(frame_type, payload):
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+
+def encode_schema(source_base, sources, point_base, points):
+    # The names in sources and points are given consecutive IDs starting at source_base and point_base
+    schema = {'source_base': source_base, 'sources': sources, 'point_base': point_base, 'points': points}
+    return encode_frame(FRAME_SCHEMA, json.dumps(schema).encode('ascii'))
+
+
+def encode_block(mjd, source_id, point_ids, values):
+    n = len(point_ids)
+    return (BLOCK_HEADER.pack(mjd, source_id, n) + struct.pack('<{}H'.format(n), *point_ids) +
+            struct.pack('<{}d'.format(n), *values))
+
+
+class MpDecoder:
+    '''Client side decoder for the binary monitor point protocol'''
+    def __init__(self):
+        self.buf = bytearray()
+        self.sources = {}
+        self.points = {}
+
+    def feed(self, data):
+        '''Add received bytes and decode all complete frames
+
+        Returns a list of (frame type, points), where points is a list of (mjd, source, monitor point, value)
+        tuples for data frames and (mjd, source, monitor point, value, age in s) tuples for snapshot frames.
+        '''
+        self.buf += data
+        frames = []
+        while len(self.buf) >= FRAME_HEADER.size:
+            length, frame_type = FRAME_HEADER.unpack_from(self.buf)
+            end = FRAME_HEADER.size + length
+            if len(self.buf) < end:
+                break
+            payload = bytes(self.buf[FRAME_HEADER.size: end])
+            del self.buf[: end]
+            if frame_type == FRAME_SCHEMA:
+                schema = json.loads(payload.decode('ascii'))
+                for i, name in enumerate(schema['sources']):
+                    self.sources[schema['source_base'] + i] = name
+                for i, name in enumerate(schema['points']):
+                    self.points[schema['point_base'] + i] = name
+                frames.append((frame_type, []))
+            elif frame_type == FRAME_SNAPSHOT:
+                now = MJD.unpack_from(payload)[0]
+                points = [(mjd, source, mp, val, (now - mjd) * SECONDS_PER_DAY)
+                          for mjd, source, mp, val in self._decode_blocks(payload, MJD.size)]
+                frames.append((frame_type, points))
+            elif frame_type == FRAME_DATA:
+                frames.append((frame_type, self._decode_blocks(payload, 0)))
+            else:
+                frames.append((frame_type, []))
+        return frames
+
+    def _decode_blocks(self, payload, offset):
+        points = []
+        while offset < len(payload):
+            mjd, source_id, n = BLOCK_HEADER.unpack_from(payload, offset)
+            offset += BLOCK_HEADER.size
+            point_ids = struct.unpack_from('<{}H'.format(n), payload, offset)
+            offset += 2 * n
+            values = struct.unpack_from('<{}d'.format(n), payload, offset)
+            offset += 8 * n
+            source = self.sources[source_id]
+            points += [(mjd, source, self.points[p], v) for p, v in zip(point_ids, values)]
+        return points
@@ -0,0 +1,69 @@
+class MpSchema:
+    '''Ordered list of monitor point names shared by all records from one kind of source'''
+    __slots__ = ('names', 'index', 'defaults')
+
+    def __init__(self, names, defaults=None):
+        '''Create a schema
+
+        Arguments
+        names -- monitor point names, in record order
+        defaults -- initial values for the monitor points, in the same order; 0.0 if not given
+        '''
+        self.names = tuple(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        if defaults is None:
+            defaults = [0.0] * len(self.names)
+        self.defaults = tuple(defaults)
+
+    def __len__(self):
+        return len(self.names)
+
+    def record(self, values=None):
+        return MpRecord(self, self.defaults if values is None else values)
+
+
+class MpRecord:
+    '''Immutable snapshot of the monitor point values of one source
+
+    Records behave like a read-only dictionary of monitor point name to value, but hold only a reference to
+    their schema and a tuple of values, so they are cheap to create and safe to hand to other threads.
+    '''
+    __slots__ = ('schema', '_values')
+
+    def __init__(self, schema, values):
+        object.__setattr__(self, 'schema', schema)
+        object.__setattr__(self, '_values', tuple(values))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MpRecord is immutable")
+
+    def __getitem__(self, name):
+        return self._values[self.schema.index[name]]
+
+    def __contains__(self, name):
+        return name in self.schema.index
+
+    def __iter__(self):
+        return iter(self.schema.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "MpRecord({})".format(self.as_dict())
+
+    def get(self, name, default=None):
+        i = self.schema.index.get(name)
+        return default if i is None else self._values[i]
+
+    def keys(self):
+        return self.schema.names
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self.schema.names, self._values)
+
+    def as_dict(self):
+        return dict(self.items())
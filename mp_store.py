@@ -0,0 +1,155 @@
+import json
+import os
+import numpy as np
+import hwmc_logging as log
+
+MODULE = os.path.basename(__file__)
+
+MAGIC = b'DSAMPB1\n'
+HEADER_SIZE = 65536     # Bytes reserved at the start of the file for the schema header
+SPARE_SLOTS = 32        # Default number of columns left for monitor points not known when a file is created
+FORMAT_VERSION = 1
+
+
+def record_dtype(point_slots):
+    # One record per (source, tick): the sample time, the source ID and a value column per point ID. Points not
+    # present in a packet are NaN.
+    return np.dtype([('mjd', '<f8'), ('source', '<u4'), ('values', '<f4', (point_slots,))])
+
+
+def read_header(f, magic=MAGIC):
+    f.seek(0)
+    block = f.read(HEADER_SIZE)
+    if not block.startswith(magic):
+        raise ValueError("Not a {} file".format(magic.decode('ascii').strip()))
+    return json.loads(block[len(magic):].rstrip(b'\0').decode('ascii'))
+
+
+def write_header(f, header, magic=MAGIC):
+    # Rewrite the header in place, leaving the file positioned at its end for appending
+    block = magic + json.dumps(header).encode('ascii')
+    if len(block) > HEADER_SIZE:
+        raise ValueError("Header full")
+    f.seek(0)
+    f.write(block.ljust(HEADER_SIZE, b'\0'))
+    f.seek(0, os.SEEK_END)
+
+
+def read_store(file_name):
+    '''Open a binary monitor point file for reading
+
+    Returns the schema header and a read-only numpy.memmap of the records, so that whole columns can be sliced
+    without reading the file. Point and source IDs are positions in header['points'] and header['sources'].
+    '''
+    with open(file_name, 'rb') as f:
+        header = read_header(f)
+    dtype = record_dtype(header['point_slots'])
+    num_records = (os.path.getsize(file_name) - HEADER_SIZE) // dtype.itemsize
+    if num_records <= 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(file_name, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(num_records,))
+
+
+def select(header, records, source, mp, t_start=None, t_end=None):
+    # Times and values of one monitor point from one source, optionally limited to t_start <= mjd < t_end
+    if source not in header['sources'] or mp not in header['points']:
+        return np.zeros(0), np.zeros(0, dtype=np.float32)
+    mask = records['source'] == header['sources'].index(source)
+    if t_start is not None:
+        mask &= records['mjd'] >= t_start
+    if t_end is not None:
+        mask &= records['mjd'] < t_end
+    selected = records[mask]
+    return selected['mjd'], selected['values'][:, header['points'].index(mp)]
+
+
+class MpStore:
+    '''Append-only binary monitor point file, holding fixed-width records behind a JSON schema header'''
+    def __init__(self, file_name, date, log_msg_q, points=(), spare_slots=SPARE_SLOTS):
+        '''Open a store for appending, creating it if necessary
+        A new file has a column for each of the known monitor points, and spare_slots more for points first seen
+        while it is written. Points that arrive once every column is taken are not stored, and are logged.
+
+        Arguments
+        file_name -- name of the file, normally one per UT day
+        date -- UT date recorded in the header of a new file
+        log_msg_q -- a Queue object for logging messages
+        points -- names of the monitor points known in advance, given the first columns of a new file
+        spare_slots -- number of further value columns in each record of a new file
+        '''
+        self.file_name = file_name
+        self.log_msg_q = log_msg_q
+        if os.path.exists(file_name) and os.path.getsize(file_name) >= HEADER_SIZE:
+            self.f = open(file_name, 'r+b')
+            self.header = read_header(self.f)
+            self.dtype = record_dtype(self.header['point_slots'])
+            # Drop any partial record left by an earlier crash
+            num_records = (os.path.getsize(file_name) - HEADER_SIZE) // self.dtype.itemsize
+            self.f.truncate(HEADER_SIZE + num_records * self.dtype.itemsize)
+        else:
+            self.f = open(file_name, 'w+b')
+            points = list(dict.fromkeys(points))
+            point_slots = len(points) + spare_slots
+            self.header = {'version': FORMAT_VERSION, 'date': date, 'point_slots': point_slots,
+                           'points': points, 'sources': []}
+            self.dtype = record_dtype(point_slots)
+            self._write_header()
+        self.f.seek(0, os.SEEK_END)
+        self.point_ids = {mp: i for i, mp in enumerate(self.header['points'])}
+        self.source_ids = {source: i for i, source in enumerate(self.header['sources'])}
+        self._slots = {}
+        self._dropped = set()
+
+    def _write_header(self):
+        write_header(self.f, self.header)
+
+    def _get_slots(self, names):
+        # Column for each point name in a packet, adding new points to the header. Points that do not fit are
+        # given column -1 and not stored.
+        slots = self._slots.get(names)
+        if slots is None:
+            new_point = False
+            for mp in names:
+                if mp in self.point_ids:
+                    continue
+                if len(self.point_ids) < self.header['point_slots']:
+                    self.point_ids[mp] = len(self.header['points'])
+                    self.header['points'].append(mp)
+                    new_point = True
+                elif mp not in self._dropped:
+                    self._dropped.add(mp)
+                    msg = "{}: All {} columns in use, not storing monitor point {}".format(
+                        self.file_name, self.header['point_slots'], mp)
+                    self.log_msg_q.put((log.ERROR, MODULE, msg))
+            if new_point:
+                self._write_header()
+            slots = np.array([self.point_ids.get(mp, -1) for mp in names])
+            self._slots[names] = slots
+        return slots
+
+    def _get_source_id(self, source):
+        source_id = self.source_ids.get(source)
+        if source_id is None:
+            source_id = len(self.header['sources'])
+            self.header['sources'].append(source)
+            self.source_ids[source] = source_id
+            self._write_header()
+        return source_id
+
+    def write(self, batch):
+        records = np.zeros(len(batch), dtype=self.dtype)
+        records['values'] = np.nan
+        for row, (timestamp, source, mp_packet) in enumerate(batch):
+            slots = self._get_slots(tuple(mp_packet.keys()))
+            values = np.fromiter(mp_packet.values(), dtype=np.float32, count=len(slots))
+            keep = slots >= 0
+            records['values'][row, slots[keep]] = values[keep]
+            records['mjd'][row] = timestamp
+            records['source'][row] = self._get_source_id(source)
+        self.f.write(records.tobytes())
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
@@ -1,14 +1,15 @@
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from matplotlib import style
+import time
+T_START = time.perf_counter()   # Start of the imports, for --profile-startup
+import argparse
 import socket
-import plotitems as pi
 import math
+from hwmc_startup import StartupProfile
 
 SECONDS_PER_DAY = 86400
 HOST_IP, SERVER_PORT = 'localhost', 50000
 SOCKET_TIMEOUT = 2.0
 NUM_ANTS = 110
+HISTORY_SECONDS = 3600  # Stored data shown when the plot opens, before live data
 
 
 class MpPlotter:
@@ -26,7 +27,8 @@ class MpPlotter:
         if mp_points:
             for m in mp_points:
                 try:
-                    mjd, ant, mp, val = m.split(',')
+                    # Snapshot lines sent on subscription carry the age of the value as an extra field
+                    mjd, ant, mp, val = m.split(',')[: 4]
                 except ValueError:
                     return
                 # Times will be referenced to initial MJD, so store it here
@@ -40,7 +42,7 @@ class MpPlotter:
                     self.xs[(ant, mp)].append((float(mjd) - self.mjd_start) * SECONDS_PER_DAY)
                     self.ys[(ant, mp)].append(float(val))
                 # Treat single plot (possibly with multiple monitor points) differently from multiple plots
-                if num_plots == 1:
+                if self.num_plots == 1:
                     self.ax['1'].clear()
                     self.ax['1'].set(xlabel='time (s)', ylabel='value', title='Multiple Monitor Points')
                     self.ax['1'].legend(['A simple line'])
@@ -92,28 +94,48 @@ mps = ['drive_state',
        'lj_temp',
        'psu_voltage']
 
-plot_items = pi.PlotItems(NUM_ANTS + 1, mps)
-mp_plot_list = plot_items.mp_list
-if plot_items.separate_plots:
-    num_plots = len(mp_plot_list)
-else:
-    num_plots = 1
 
-style.use('classic')
-fig = plt.figure(facecolor='white')
-ax = {}
-if num_plots == 1:
-    ax['1'] = (fig.add_subplot(1, 1, 1))
+def main():
+    parser = argparse.ArgumentParser(description="Plot DSA-110 antenna monitor points")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print the time taken by each phase of start up")
+    args = parser.parse_args()
+    profile = StartupProfile(T_START)
+    profile.mark('imports')
 
-else:
-    plot_rows = int(math.sqrt(num_plots) + 0.9999)
-    plot_cols = int(num_plots / plot_rows + 0.9999)
-    num_pos = plot_rows * plot_cols
-    for i in range(num_plots):
-        ax[mp_plot_list[i]] = (fig.add_subplot(plot_rows, plot_cols, i + 1, ))
+    # The GUI libraries are only loaded once they are needed
+    import plotitems as pi
+    profile.mark('import tkinter')
+    plot_items = pi.PlotItems(NUM_ANTS + 1, mps)
+    mp_plot_list = plot_items.mp_list
+    if plot_items.separate_plots:
+        num_plots = len(mp_plot_list)
+    else:
+        num_plots = 1
+    # The time spent choosing monitor points is not part of start up
+    profile.skip()
+    if not mp_plot_list:
+        print("Finished")
+        return
 
+    import matplotlib.pyplot as plt
+    import matplotlib.animation as animation
+    from matplotlib import style
+    profile.mark('import matplotlib')
+
+    style.use('classic')
+    fig = plt.figure(facecolor='white')
+    ax = {}
+    if num_plots == 1:
+        ax['1'] = (fig.add_subplot(1, 1, 1))
+
+    else:
+        plot_rows = int(math.sqrt(num_plots) + 0.9999)
+        plot_cols = int(num_plots / plot_rows + 0.9999)
+        for i in range(num_plots):
+            ax[mp_plot_list[i]] = (fig.add_subplot(plot_rows, plot_cols, i + 1, ))
+    profile.mark('figure')
 
-if mp_plot_list:
     connected = False
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.settimeout(SOCKET_TIMEOUT)
@@ -137,11 +159,18 @@ if mp_plot_list:
     mp = ''
     if connected:
         for item in mp_plot_list:
-            mp = "{}{},{}\n".format(mp, item[0], item[1])
+            mp = "{}history {} {},{}\n".format(mp, HISTORY_SECONDS, item[0], item[1])
         print(mp)
         s.sendall(mp.encode('ascii'))
+        profile.mark('connect')
+        if args.profile_startup:
+            print(profile.report())
 
         mp_plotter = MpPlotter(s, num_plots, ax)
         ani = animation.FuncAnimation(fig, mp_plotter.update, interval=500)
         plt.show()
-print("Finished")
+    print("Finished")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import hwmc_logging as log
+
+MODULE = os.path.basename(__file__)
+CLOSE_TIMEOUT = 1.0     # Longest wait for connections to close when stopping
+
+
+class ServerLoop:
+    '''A single asyncio event loop serving every network connection
+
+    Servers added to the loop provide coroutines start() and close(). Other threads hand work to the loop with
+    call_soon(), which is the only thread-safe entry point.
+    '''
+    def __init__(self, log_msg_q):
+        self.log_msg_q = log_msg_q
+        self.loop = asyncio.new_event_loop()
+        self.servers = []
+        self._stop_event = None
+
+    def add(self, server):
+        self.servers.append(server)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    async def _main(self):
+        self._stop_event = asyncio.Event()
+        for server in self.servers:
+            await server.start()
+        self.log_msg_q.put((log.INFO, MODULE, "Serving {} servers".format(len(self.servers))))
+        await self._stop_event.wait()
+        for server in self.servers:
+            await server.close()
+        # Let connection handlers see their connections close before the loop is closed
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            await asyncio.wait(tasks, timeout=CLOSE_TIMEOUT)
+        self.log_msg_q.put((log.INFO, MODULE, "Servers stopped"))
+
+    def call_soon(self, callback, *args):
+        # Schedule callback(*args) to run on the loop from any thread
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The loop has already been closed
+            pass
+
+    def stop(self):
+        self.call_soon(self._set_stop)
+
+    def _set_stop(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+        else:
+            # Stopped before the servers were started
+            self.loop.call_soon(self._set_stop)
@@ -0,0 +1,335 @@
+import collections
+import itertools
+import math
+import random
+import threading
+import time
+
+# Stand-in for the labjack.ljm functions used by this package, for running and load testing without hardware.
+# Each simulated T7 models an antenna: an elevation drive that responds to the drive and brake outputs, the
+# elevation encoder, limit switches, noise diodes, temperatures and RF powers. State is advanced from the time of
+# each call, so there are no background threads and thousands of devices cost nothing while idle.
+
+NUM_DEVICES = 110       # Devices found by listAll unless configure() says otherwise
+FIRST_SERIAL = 470000001
+WRITE_LOG = 1000        # Writes remembered per device, with their times, for benchmarks
+
+DRIVE_RATE = 40.0       # Elevation rate in deg/min
+MIN_EL = 0.0            # Mechanical stops in deg
+MAX_EL = 180.0
+MINUS_LIMIT_EL = 5.0    # Limit switches, which also stop the drive in that direction
+PLUS_LIMIT_EL = 175.0
+STOW_EL = 90.0          # Elevation of every antenna at start up
+ENCODER_SCALE = 45.0    # Encoder voltage is (el - ENCODER_OFFSET) / ENCODER_SCALE
+ENCODER_OFFSET = -22.5
+ENCODER_NOISE = 0.0005  # Volts rms
+
+DAY = 86400.0
+RF_POWER = -40.0        # RF power in dBm with the noise diodes off
+ND_POWER = 3.0          # Increase in RF power in dB with a noise diode on
+ANALOG_NOISE = 0.002    # Volts rms on the other analog inputs
+
+# Analog inputs other than the encoder: AIN number -> (nominal physical value, scale, offset), where the voltage
+# is (value - offset) / scale. Temperatures vary over the day by DIURNAL_SWING.
+AIN_MODEL = {1: (20.0, 50.0, -25.0),        # focus temperature, deg C
+             2: (30.0, 100.0, 0.0),         # LNA A current, mA
+             4: (3.0, 1.0, 0.0),            # laser A voltage
+             5: (50.0, 1000.0, 0.0),        # FEB A current, mA
+             6: (30.0, 50.0, -25.0),        # FEB A temperature, deg C
+             7: (30.0, 1000.0, 0.0),        # LNA B current, mA
+             9: (3.0, 1.0, 0.0),            # laser B voltage
+             10: (50.0, 100.0, 0.0),        # FEB B current, mA
+             11: (30.0, 50.0, -25.0),       # FEB B temperature, deg C
+             12: (5.0, 1.0, 0.0),           # PSU voltage
+             13: (0.0, 1.0, 0.0)}
+TEMPERATURE_AINS = (1, 6, 11)
+RF_AINS = {3: 'MIO0', 8: 'MIO1'}        # RF power inputs and the noise diode outputs that affect them
+RF_SCALE = 28.571
+RF_OFFSET = -90.0
+DIURNAL_SWING = 5.0     # deg C
+DEVICE_TEMP_K = 300.0
+
+# DIO_STATE bits, as decoded by dsa_labjack's DRIVE_STATE, BRAKE_STATE and LIMIT_STATE. The drive state is 1 for up
+# and 2 for down, while the brake and limit switch inputs are 0 when on.
+DRIVE_SHIFT = 8
+BRAKE_BIT = 16
+PLUS_LIMIT_BIT = 17
+MINUS_LIMIT_BIT = 18
+ND_A_BIT = 20
+ND_B_BIT = 21
+FAN_ERR_BIT = 22
+
+LJME_DEVICE_NOT_FOUND = 1227
+LJME_DEVICE_NOT_OPEN = 1224
+LJME_NO_RESPONSE_BYTES_RECEIVED = 1264
+
+
+class LJMError(Exception):
+    def __init__(self, errorCode=0, errorString=''):
+        super().__init__(errorString)
+        self.errorCode = errorCode
+        self.errorString = errorString
+
+
+class constants:
+    dtANY = 0
+    dtT7 = 7
+    ctANY = 0
+    ctUSB = 1
+    ctTCP = 2
+    ctETHERNET = 3
+
+
+class Settings:
+    '''Simulation parameters shared by all devices, changed with configure()'''
+    def __init__(self):
+        self.num_devices = NUM_DEVICES
+        self.latency = 0.0          # Added to every call, in s
+        self.jitter = 0.0           # Standard deviation of a random addition to the latency, in s
+        self.fault_rate = 0.0       # Probability of any call failing with an LJMError
+        self.dead = set()           # Serial numbers of devices that cannot be opened
+        self.stalled = set()        # Serial numbers of devices whose drives do not move
+        self.seed = 0
+
+
+settings = Settings()
+devices = {}
+_handles = itertools.count(1)
+_lock = threading.Lock()
+_random = random.Random()
+
+
+def configure(num_devices=NUM_DEVICES, latency=0.0, jitter=0.0, fault_rate=0.0, dead_fraction=0.0,
+              stall_fraction=0.0, seed=0):
+    '''Set up the simulated array before devices are listed and opened
+
+    Arguments
+    num_devices -- number of devices returned by listAll; locations are 1 to num_devices
+    latency, jitter -- mean and standard deviation of the time taken by each call in s
+    fault_rate -- probability that any call on an open device fails
+    dead_fraction -- fraction of devices that fail to open
+    stall_fraction -- fraction of devices whose elevation drives do not move
+    seed -- seed for the random choices and noise, so runs can be repeated
+    '''
+    rng = random.Random(seed)
+    settings.num_devices = num_devices
+    settings.latency = latency
+    settings.jitter = jitter
+    settings.fault_rate = fault_rate
+    serials = [FIRST_SERIAL + i for i in range(num_devices)]
+    settings.dead = set(rng.sample(serials, int(dead_fraction * num_devices)))
+    settings.stalled = set(rng.sample(serials, int(stall_fraction * num_devices)))
+    settings.seed = seed
+    _random.seed(seed)
+
+
+class SimDevice:
+    '''One simulated antenna LabJack'''
+    def __init__(self, serial_number, location):
+        self.serial_number = serial_number
+        self.location = location
+        self.stalled = serial_number in settings.stalled
+        self.rng = random.Random(settings.seed * 100003 + serial_number)
+        self.lock = threading.Lock()
+        self.registers = {'EIO0': 1, 'EIO1': 1, 'EIO2': 1, 'MIO0': 1, 'MIO1': 1}
+        self.writes = collections.deque(maxlen=WRITE_LOG)
+        self.el = STOW_EL
+        self.fan_err = 0
+        self.t = time.monotonic()
+        self.stream = None
+
+    def _direction(self):
+        # Drive outputs are active low: EIO0 drives up and EIO1 drives down. The brake output EIO2 is on when 1.
+        if self.stalled or self.registers['EIO2']:
+            return 0
+        up = not self.registers['EIO0']
+        down = not self.registers['EIO1']
+        if up and not down and self.el < PLUS_LIMIT_EL:
+            return 1
+        if down and not up and self.el > MINUS_LIMIT_EL:
+            return -1
+        return 0
+
+    def _advance(self):
+        now = time.monotonic()
+        direction = self._direction()
+        if direction:
+            el = self.el + direction * DRIVE_RATE / 60.0 * (now - self.t)
+            # The limit switches cut the drive as soon as they are reached
+            if direction > 0:
+                el = min(el, max(PLUS_LIMIT_EL, self.el))
+            else:
+                el = max(el, min(MINUS_LIMIT_EL, self.el))
+            self.el = min(max(el, MIN_EL), MAX_EL)
+        self.t = now
+
+    def write(self, name, values):
+        with self.lock:
+            self._advance()
+            if isinstance(values, (list, tuple)):
+                # Array writes continue through the following registers, e.g. EIO0 then EIO1
+                prefix = name.rstrip('0123456789')
+                start = int(name[len(prefix):])
+                for i, value in enumerate(values):
+                    self.registers["{}{}".format(prefix, start + i)] = value
+            else:
+                self.registers[name] = values
+            self.writes.append((time.perf_counter(), name, values))
+
+    def read(self, name, num_values=1):
+        with self.lock:
+            self._advance()
+            if name.startswith('AIN') and name[3:].isdigit():
+                start = int(name[3:])
+                return [self._ain(start + i) for i in range(num_values)]
+            return [self._register(name)] + [0.0] * (num_values - 1)
+
+    def _register(self, name):
+        if name == 'TEMPERATURE_DEVICE_K':
+            return DEVICE_TEMP_K + self._diurnal() / 2 + self.rng.gauss(0.0, 0.05)
+        if name == 'DIO_STATE':
+            return float(self._dio_state())
+        if name == 'FIO_STATE':
+            return float(self.location & 0x7f)
+        return self.registers.get(name, 0.0)
+
+    def _diurnal(self):
+        return DIURNAL_SWING * math.sin(2 * math.pi * (time.time() / DAY + self.location / 110.0))
+
+    def _ain(self, channel):
+        if channel == 0:
+            return (self.el - ENCODER_OFFSET) / ENCODER_SCALE + self.rng.gauss(0.0, ENCODER_NOISE)
+        if channel in RF_AINS:
+            power = RF_POWER + (ND_POWER if not self.registers[RF_AINS[channel]] else 0.0)
+            return (power - RF_OFFSET) / RF_SCALE + self.rng.gauss(0.0, ANALOG_NOISE)
+        value, scale, offset = AIN_MODEL.get(channel, (0.0, 1.0, 0.0))
+        if channel in TEMPERATURE_AINS:
+            value += self._diurnal()
+        return (value - offset) / scale + self.rng.gauss(0.0, ANALOG_NOISE)
+
+    def _dio_state(self):
+        r = self.registers
+        state = (int(not r['EIO0']) | int(not r['EIO1']) << 1) << DRIVE_SHIFT
+        state |= int(not r['EIO2']) << BRAKE_BIT
+        state |= (self.el < PLUS_LIMIT_EL) << PLUS_LIMIT_BIT
+        state |= (self.el > MINUS_LIMIT_EL) << MINUS_LIMIT_BIT
+        state |= int(r['MIO0']) << ND_A_BIT | int(r['MIO1']) << ND_B_BIT
+        state |= self.fan_err << FAN_ERR_BIT
+        return state | (self.location & 0x7f)
+
+
+def _call(handle):
+    # Every call on an open device takes the configured time and may fail
+    if settings.latency or settings.jitter:
+        time.sleep(max(settings.latency + _random.gauss(0.0, settings.jitter), 0.0))
+    if settings.fault_rate and _random.random() < settings.fault_rate:
+        raise LJMError(LJME_NO_RESPONSE_BYTES_RECEIVED, "LJME_NO_RESPONSE_BYTES_RECEIVED (simulated fault)")
+    try:
+        return devices[handle]
+    except KeyError:
+        raise LJMError(LJME_DEVICE_NOT_OPEN, "LJME_DEVICE_NOT_OPEN")
+
+
+def writeLibraryConfigS(parameter, value):
+    pass
+
+
+def listAll(deviceType, connectionType):
+    n = settings.num_devices
+    serials = [FIRST_SERIAL + i for i in range(n)]
+    addresses = [(10 << 24) + (1 << 16) + i for i in range(n)]
+    return n, [constants.dtT7] * n, [constants.ctTCP] * n, serials, addresses
+
+
+def open(deviceType=constants.dtANY, connectionType=constants.ctANY, identifier="ANY"):
+    if identifier == "ANY":
+        identifier = FIRST_SERIAL
+    try:
+        serial_number = int(identifier)
+    except ValueError:
+        raise LJMError(LJME_DEVICE_NOT_FOUND, "LJME_DEVICE_NOT_FOUND")
+    location = serial_number - FIRST_SERIAL + 1
+    if not 0 < location <= settings.num_devices or serial_number in settings.dead:
+        raise LJMError(LJME_DEVICE_NOT_FOUND, "LJME_DEVICE_NOT_FOUND")
+    if settings.latency or settings.jitter:
+        time.sleep(max(settings.latency + _random.gauss(0.0, settings.jitter), 0.0))
+    with _lock:
+        handle = next(_handles)
+        devices[handle] = SimDevice(serial_number, location)
+    return handle
+
+
+def close(handle):
+    with _lock:
+        devices.pop(handle, None)
+
+
+def eReadName(handle, name):
+    return _call(handle).read(name)[0]
+
+
+def eReadNameArray(handle, name, numValues):
+    return _call(handle).read(name, numValues)
+
+
+def eWriteName(handle, name, value):
+    _call(handle).write(name, value)
+
+
+def eWriteNames(handle, numFrames, aNames, aValues):
+    device = _call(handle)
+    for name, value in zip(aNames[: numFrames], aValues):
+        device.write(name, value)
+
+
+def eWriteNameArray(handle, name, numValues, aValues):
+    _call(handle).write(name, list(aValues[: numValues]))
+
+
+def eNames(handle, numFrames, aNames, aWrites, aNumValues, aValues):
+    device = _call(handle)
+    values = []
+    offset = 0
+    for name, write, num_values in zip(aNames[: numFrames], aWrites, aNumValues):
+        if write:
+            device.write(name, list(aValues[offset: offset + num_values]))
+            values.extend(aValues[offset: offset + num_values])
+        else:
+            values.extend(device.read(name, num_values))
+        offset += num_values
+    return values
+
+
+def nameToAddress(name):
+    # Only the analog inputs can be streamed; they are FLOAT32 registers two addresses apart
+    if name.startswith('AIN') and name[3:].isdigit():
+        return int(name[3:]) * 2, 3
+    raise LJMError(LJME_DEVICE_NOT_FOUND, "Unknown register {}".format(name))
+
+
+def eStreamStart(handle, scansPerRead, numAddresses, aScanList, scanRate):
+    device = _call(handle)
+    device.stream = (scansPerRead, [address // 2 for address in aScanList[: numAddresses]], scanRate,
+                     time.monotonic())
+    return scanRate
+
+
+def eStreamRead(handle):
+    # Blocks until a read's worth of scans is due, like the real stream, and returns them all
+    device = _call(handle)
+    scans_per_read, channels, scan_rate, due = device.stream
+    due += scans_per_read / scan_rate
+    device.stream = (scans_per_read, channels, scan_rate, due)
+    wait = due - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    data = []
+    for _ in range(scans_per_read):
+        with device.lock:
+            device._advance()
+            data.extend(device._ain(channel) for channel in channels)
+    return data, 0, 0
+
+
+def eStreamStop(handle):
+    _call(handle).stream = None
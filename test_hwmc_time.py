@@ -0,0 +1,77 @@
+import calendar
+import datetime
+import random
+import time
+import warnings
+import erfa
+import pytest
+from astropy.time import Time
+import hwmc_time
+
+# Checks hwmc_time against astropy, which it replaced in the hot paths. astropy is only needed to run these tests;
+# see requirements-test.txt.
+
+NUM_TIMES = 100000
+UTC_1972 = 63072000000000   # Start of 1972 in us since the Unix epoch, when UTC took its current form
+UTC_END = 4100000000000000  # About 2099 in us since the Unix epoch
+
+
+@pytest.fixture(autouse=True)
+def ignore_erfa_warnings():
+    # ERFA warns about dates beyond its leap second table
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        yield
+
+
+def random_times():
+    # Whole microseconds, as datetimes hold, at random and either side of midnight, avoiding exact half
+    # milliseconds, where rounding may differ
+    rng = random.Random(1)
+    us = [rng.randrange(UTC_1972, UTC_END) for _ in range(NUM_TIMES)]
+    us_per_day = hwmc_time.SECONDS_PER_DAY * 1000000
+    for n in range(1000):
+        midnight = rng.randrange(UTC_1972 // us_per_day, UTC_END // us_per_day) * us_per_day
+        us += [midnight - 400 - n, midnight + n]
+    times = [u / 1e6 for u in us if u % 1000 != 500]
+    times.append(time.time())
+    return times
+
+
+def reference(times):
+    # The reference times are made from datetimes, as Time.now() does, so leap seconds are treated the same way
+    return Time([datetime.datetime.fromtimestamp(t, datetime.timezone.utc) for t in times], scale='utc')
+
+
+def leap_days():
+    # MJD days that end in a leap second
+    return {hwmc_time.day(calendar.timegm((year, month, 1, 0, 0, 0))) - 1
+            for year, month, _ in erfa.leap_seconds.get() if year >= 1972}
+
+
+def test_iso_and_day():
+    times = random_times()
+    ref = reference(times)
+    for t, t_mjd, t_iso in zip(times, ref.mjd, ref.iso):
+        assert hwmc_time.iso(t) == t_iso, t
+        assert hwmc_time.day(t) == int(t_mjd // 1), t
+
+
+def test_mjd():
+    # On a day ending in a leap second astropy's MJD spreads the day over 86401 s, so those days are left out
+    times = random_times()
+    skip = leap_days()
+    times = [t for t in times if hwmc_time.day(t) not in skip]
+    worst = max(abs(hwmc_time.mjd(t) - t_mjd) for t, t_mjd in zip(times, reference(times).mjd))
+    assert worst * hwmc_time.SECONDS_PER_DAY < 2e-6
+
+
+def test_date():
+    days = list(range(hwmc_time.MJD_UNIX_EPOCH - 1000, hwmc_time.MJD_UNIX_EPOCH + 47000, 7))
+    for mjd_day, ref_date in zip(days, Time(days, format='mjd').iso):
+        assert hwmc_time.date(mjd_day) == ref_date[: 10], mjd_day
+
+
+def test_now():
+    assert abs(hwmc_time.mjd() - Time.now().mjd) * hwmc_time.SECONDS_PER_DAY < 0.01
+    assert hwmc_time.day() == int(Time.now().mjd)
@@ -0,0 +1,51 @@
+import queue
+import monitor_server
+
+# Subscriptions are checked by dispatching packets directly, without a running server or network connection
+
+
+class FakeWriter:
+    def __init__(self, number):
+        self.number = number
+
+    def get_extra_info(self, name):
+        return 'client', self.number
+
+
+def make_client(server, number):
+    client = monitor_server.MpClient(FakeWriter(number), number)
+    server.clients.add(client)
+    return client
+
+
+def received(client):
+    lines = client.out_buf.decode('ascii').splitlines()
+    client.out_buf.clear()
+    return [tuple(line.split(',')[1: 3]) for line in lines]
+
+
+def test_pattern_then_exact_subscription():
+    # The exact subscription creates the index entry for a point before it is first seen, which the wildcard
+    # subscription must still be added to
+    server = monitor_server.MpServer(None, queue.Queue())
+    pattern_client = make_client(server, 1)
+    exact_client = make_client(server, 2)
+    server.subscribe(monitor_server.Subscription(pattern_client, 'ant*', 'el'))
+    server.subscribe(monitor_server.Subscription(exact_client, 'ant1', 'el'))
+    server.dispatch([(60000.0, 'ant1', {'el': 45.0, 'az': 0.0})])
+    assert received(pattern_client) == [('ant1', 'el')]
+    assert received(exact_client) == [('ant1', 'el')]
+    server.dispatch([(60000.1, 'ant2', {'el': 46.0})])
+    assert received(pattern_client) == [('ant2', 'el')]
+    assert received(exact_client) == []
+
+
+def test_exact_then_pattern_subscription():
+    server = monitor_server.MpServer(None, queue.Queue())
+    pattern_client = make_client(server, 1)
+    exact_client = make_client(server, 2)
+    server.subscribe(monitor_server.Subscription(exact_client, 'ant1', 'el'))
+    server.subscribe(monitor_server.Subscription(pattern_client, 'ant*', 'el'))
+    server.dispatch([(60000.0, 'ant1', {'el': 45.0})])
+    assert received(pattern_client) == [('ant1', 'el')]
+    assert received(exact_client) == [('ant1', 'el')]
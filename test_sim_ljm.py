@@ -0,0 +1,33 @@
+import queue
+import dsa_labjack as dlj
+
+# The simulated DIO_STATE register must decode through dsa_labjack's tables the way the real hardware does
+
+
+class NullMonitor:
+    def post(self, mp):
+        pass
+
+
+def decoded_state(ant):
+    mps = ant.get_data()
+    return (dlj.DRIVE_STATE[mps['drive_state']], dlj.BRAKE_STATE[mps['brake']],
+            dlj.LIMIT_STATE[mps['plus_limit']], dlj.LIMIT_STATE[mps['minus_limit']])
+
+
+def sim_ant():
+    return dlj.LabjackList(queue.Queue(), NullMonitor(), simulate=True, num_sim=1).ants[1]
+
+
+def test_idle_antenna():
+    assert decoded_state(sim_ant()) == (' Off', ' On', 'Off', 'Off')
+
+
+def test_driving_antenna():
+    ant = sim_ant()
+    ant.move_ant(['up'])
+    assert decoded_state(ant) == ('  Up', 'Off', 'Off', 'Off')
+    ant.move_ant(['down'])
+    assert decoded_state(ant) == ('Down', 'Off', 'Off', 'Off')
+    ant.move_ant(['stop'])
+    assert decoded_state(ant) == (' Off', ' On', 'Off', 'Off')